@@ -1,7 +1,8 @@
 from dataclasses import dataclass
 from collections import deque
+from itertools import islice
 from bitarray import bitarray
-from bitarray.util import int2ba, ba2int
+from bitarray.util import int2ba, ba2int, canonical_decode
 
 @dataclass
 class huffman_adaptive_node():
@@ -179,13 +180,31 @@ class huffman_adaptive_node():
 class huffman_adaptive_tree:
     """
     Tree-based adaptive Huffman coder
+
+    By default the implicit order and codebook are rebuilt from scratch
+    after every change, which keeps the algorithm easy to follow. With
+    incremental=True they are maintained in place instead: a node -> index
+    map replaces the linear searches, interchanged nodes swap their entries
+    in the implicit order, and only the codewords below nodes that moved are
+    recomputed. Both modes produce the same output.
     """
-    def __init__(self):
+    def __init__(self, alphabet_size=256, incremental=False):
+        if(alphabet_size < 2):
+            raise ValueError("alphabet_size has to be at least 2")
         self.root = huffman_adaptive_node(parent=None, weight=0)
         self.nyt = self.root        # NYT node
         self.implicit_order = []    # list of all nodes in descending implicit order
         self.codebook = {}          # dict for input data encoding table
-        self.alphabet_size = 256    # max number of symbols
+        self.alphabet_size = alphabet_size  # max number of symbols
+        # number of bits for the binary code of a new symbol
+        self.symbol_bits = (alphabet_size - 1).bit_length()
+        self.incremental = incremental
+        if(self.incremental):
+            self.implicit_order = [self.root]
+            # id(node) -> position in implicit order (nodes aren't hashable)
+            self.index = {id(self.root): 0}
+            self.leaves = {}                # symbol -> leaf node
+            self.moved = []                 # nodes whose codewords need recomputing
 
     def encode_symbol(self, symbol):
         """
@@ -204,26 +223,41 @@ class huffman_adaptive_tree:
         p = self._find_symbol(symbol)   # pointer to leaf node containing next symbol
         if(p is self.nyt):
             if(len(self.codebook) == 0):
-                encoded_symbol = int2ba(symbol, length=8)
+                encoded_symbol = int2ba(symbol, length=self.symbol_bits)
             else:
-                encoded_symbol = self.codebook[None] + int2ba(symbol, length=8)
+                encoded_symbol = self.codebook[None] + int2ba(symbol, length=self.symbol_bits)
             if(len(self.implicit_order) == (2*self.alphabet_size - 1)):
                 p.value = symbol
                 self.nyt = None
+                if(self.incremental):
+                    del self.codebook[None]
+                    self.leaves[symbol] = p
+                    self.moved.append(p)
             else:
                 p.left_child = huffman_adaptive_node(parent=p, weight=0, value=None)
                 p.right_child = huffman_adaptive_node(parent=p, weight=0, value=symbol)
                 self.nyt = p.left_child
                 leaf_to_increment = p.right_child
-                self._update_implicit_order()
+                if(self.incremental):
+                    # NYT is last in the implicit order, so its children go
+                    # right after it
+                    self._append_to_order(p.right_child)
+                    self._append_to_order(p.left_child)
+                    self.leaves[symbol] = p.right_child
+                    self.moved.append(p)
+                else:
+                    self._update_implicit_order()
         else:
             encoded_symbol = self.codebook[symbol]
             # swap p with leader of its block
-            for node in self.implicit_order:
-                if((node.weight == p.weight) and node.is_leaf):  # find leader
-                    p.swap_nodes(node)
-                    self._update_implicit_order()
-                    break
+            if(self.incremental):
+                self._swap_with_leader(p)
+            else:
+                for node in self.implicit_order:
+                    if((node.weight == p.weight) and node.is_leaf):  # find leader
+                        p.swap_nodes(node)
+                        self._update_implicit_order()
+                        break
             if(p is self.implicit_order[-2]):  # p is sibling of NYT node
                 leaf_to_increment = p
                 p = p.parent
@@ -231,36 +265,37 @@ class huffman_adaptive_tree:
             p = self._slide_and_increment(p)
         if(leaf_to_increment is not None):
             p = self._slide_and_increment(leaf_to_increment)
-        self._update_codebook(self.root)
+        if(self.incremental):
+            self._update_moved_codewords()
+        else:
+            self._update_codebook(self.root)
         return encoded_symbol
         
-    def decode_symbol(self, encoded_bitarray):
+    def decode_symbol(self, encoded_bitarray, offset=0):
         """
-        First symbol is special case. Read 8 bits for symbol binary code.
-        
-        For subsequent symbols, read in bits until a match in the codebook is
-        found. If node is NYT, read next 8 bits for symbol binary code. If
-        symbol is not NYT, find symbol from codebook then update tree.
-        """
-        num_bits = 1
-        symbol = None
-        if(self.nyt is self.root):
-            # special case for first symbol
-            symbol = ba2int(encoded_bitarray[0:8])
-            num_bits = 8
-        else: 
-            # read in bits until a codeword is found (NYT is in codebook)
-            # if NYT then read in another 8 bits for symbol binary code
-            path = encoded_bitarray[0:num_bits]
-            while(path not in self.codebook.values()):
-                num_bits += 1
-                path = encoded_bitarray[0:num_bits]
-            key = list(self.codebook.keys())[list(self.codebook.values()).index(path)]
-            if(key is None):  # new symbol
-                symbol = ba2int(encoded_bitarray[num_bits:num_bits+8])
-                num_bits += 8
+        Decode the symbol starting at encoded_bitarray[offset]. Returns the
+        symbol and the number of bits it took.
+
+        Walk down from the root one bit at a time until a leaf is reached
+        (for the first symbol the root is the NYT leaf). If the leaf is NYT,
+        read the next symbol_bits bits for the symbol binary code, then update
+        the tree.
+        The bits are never copied, so decoding a whole stream by moving offset
+        along is linear in its length.
+        """
+        num_bits = 0
+        p = self.root
+        while(p.is_leaf is False):
+            if(encoded_bitarray[offset + num_bits]):
+                p = p.right_child
             else:
-                symbol = key
+                p = p.left_child
+            num_bits += 1
+        if(p is self.nyt):  # new symbol
+            symbol = ba2int(encoded_bitarray[offset + num_bits:offset + num_bits + self.symbol_bits])
+            num_bits += self.symbol_bits
+        else:
+            symbol = p.value
         self.encode_symbol(symbol)
         return symbol, num_bits
 
@@ -269,6 +304,8 @@ class huffman_adaptive_tree:
         Internal function to update the tree
         """
         def _get_index():
+            if(self.incremental):
+                return self.index[id(p)]
             for i in range(len(self.implicit_order)):
                 if(p is self.implicit_order[i]):
                     return i
@@ -282,12 +319,13 @@ class huffman_adaptive_tree:
             else:
                 while((self.implicit_order[idx-1].is_leaf and (self.implicit_order[idx-1].weight <= p.weight+1))
                       or ((self.implicit_order[idx-1].is_leaf is False) and (self.implicit_order[idx-1].weight <= p.weight))):
-                    p.swap_nodes(self.implicit_order[idx-1])
+                    self._swap(p, self.implicit_order[idx-1])
                     idx -= 1
             # increase weight of p by 1
             p.weight += 1
             p = prev_p
-            self._update_implicit_order()
+            if(not self.incremental):
+                self._update_implicit_order()
         else:  # p is leaf
             # slide p higher than internal nodes of wt
             idx = _get_index()
@@ -295,18 +333,81 @@ class huffman_adaptive_tree:
                 pass
             else:
                 while(self.implicit_order[idx-1].weight <= p.weight):
-                    p.swap_nodes(self.implicit_order[idx-1])
+                    self._swap(p, self.implicit_order[idx-1])
                     idx -= 1
             # increase weight of p by 1
             p.weight += 1
             p = p.parent
-            self._update_implicit_order()
+            if(not self.incremental):
+                self._update_implicit_order()
         return p
 
+    def _swap(self, p, node):
+        """
+        Internal function to interchange two nodes. In incremental mode their
+        entries in the implicit order are swapped as well (rather than
+        rebuilding it afterwards) and both are queued for codeword updates.
+        """
+        p.swap_nodes(node)
+        if(self.incremental and (p is not node)):
+            i, j = self.index[id(p)], self.index[id(node)]
+            self.implicit_order[i], self.implicit_order[j] = node, p
+            self.index[id(p)], self.index[id(node)] = j, i
+            self.moved.append(p)
+            self.moved.append(node)
+
+    def _swap_with_leader(self, p):
+        """
+        Internal function to swap leaf p with the leader of its block, i.e.
+        the first leaf of the same weight in the implicit order. Weights are
+        non-increasing along the implicit order, so only the run of nodes with
+        p's weight right before p has to be searched.
+        """
+        i = self.index[id(p)]
+        leader = p
+        while((i > 0) and (self.implicit_order[i-1].weight == p.weight)):
+            i -= 1
+            if(self.implicit_order[i].is_leaf):
+                leader = self.implicit_order[i]
+        self._swap(p, leader)
+
+    def _append_to_order(self, node):
+        self.index[id(node)] = len(self.implicit_order)
+        self.implicit_order.append(node)
+
+    def _codeword(self, node):
+        """
+        Internal function to get the codeword of node by walking up the tree
+        """
+        path = bitarray()
+        while(node.parent is not None):
+            path.append(node.is_right_child)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def _update_moved_codewords(self):
+        """
+        Internal function to recompute the codewords of the leaves below the
+        nodes that moved while encoding the last symbol
+        """
+        moved = {id(node): node for node in self.moved}
+        self.moved = []
+        for node in moved.values():
+            # skip nodes that are below another moved node, they get updated
+            # with it
+            p = node.parent
+            while((p is not None) and (id(p) not in moved)):
+                p = p.parent
+            if(p is None):
+                self._update_codebook(node, self._codeword(node), reset=False)
+
     def _find_symbol(self, symbol):
         """
         Internal function to return a pointer to the leaf node for the symbol
         """
+        if(self.incremental):
+            return self.leaves.get(symbol, self.nyt)
         p = self.root
         if(symbol in self.codebook):
             path = self.codebook[symbol].copy()
@@ -337,12 +438,14 @@ class huffman_adaptive_tree:
                 self.implicit_order.append(v.left_child)
                 q.append(v.left_child)
             
-    def _update_codebook(self, node, path=None):
+    def _update_codebook(self, node, path=None, reset=True):
         """
-        Internal function to update codebook by DFS
+        Internal function to update codebook by DFS. With reset=False only the
+        codewords below node (whose codeword is path) are updated.
         """
         if(path is None):  # initialize
             path = bitarray()
+        if(reset):
             self.codebook = {}
         # if leaf, add codeword to codebook
         if(node.is_leaf):
@@ -350,15 +453,32 @@ class huffman_adaptive_tree:
         # DFS
         if(node.left_child is not None):
             path += "0"
-            path = self._update_codebook(node.left_child, path)
+            path = self._update_codebook(node.left_child, path, reset=False)
         if(node.right_child is not None):
             path += "1"
-            path = self._update_codebook(node.right_child, path)
+            path = self._update_codebook(node.right_child, path, reset=False)
         # update visited before going up the tree a level
         path = path[:-1]
         return path
 
 
+    def code_lengths(self):
+        """
+        Codeword length of every symbol seen so far (NYT is left out)
+        """
+        return {symbol: len(code) for symbol, code in self.codebook.items() if symbol is not None}
+
+    def freeze(self):
+        """
+        Canonical code with the codeword lengths the tree has right now, for
+        coding a segment in which the model stays frozen (e.g. after a warm
+        up). Encoder and decoder both freeze at the same point, code the
+        segment with it and can go on adaptively afterwards; the tree isn't
+        changed and doesn't count the segment's symbols. Only symbols seen
+        before freezing can be coded.
+        """
+        return canonical_huffman_code(self.code_lengths())
+
     def print_tree(self):
         """
         Print out the tree line graph, implicit order, and codebook
@@ -380,6 +500,55 @@ class huffman_adaptive_tree:
 
 
 
+class canonical_huffman_code:
+    """
+    Canonical prefix code for given codeword lengths: codewords of the same
+    length are consecutive numbers in symbol order, and each length starts
+    where the previous one ended, shifted left by one. The code is then
+    described by how many codewords there are of each length (count) and the
+    symbols in codeword order, and decoding works from these first-code/offset
+    tables with bitarray's canonical_decode instead of walking a tree one bit
+    at a time. Doesn't need to be complete (a frozen tree has no NYT).
+    """
+    def __init__(self, lengths):
+        self.lengths = lengths
+        self.symbols = sorted(lengths, key=lambda symbol: (lengths[symbol], symbol))
+        max_length = max(lengths.values(), default=0)
+        self.count = [0] * (max_length + 1)
+        for symbol in self.symbols:
+            self.count[lengths[symbol]] += 1
+        self.codebook = {}
+        code = 0
+        i = 0
+        for length in range(1, max_length + 1):
+            for symbol in self.symbols[i:i + self.count[length]]:
+                self.codebook[symbol] = int2ba(code, length=length)
+                code += 1
+            i += self.count[length]
+            code <<= 1
+
+    def encode(self, symbols):
+        """
+        Codewords of all symbols as one bitarray
+        """
+        encoded_bitarray = bitarray()
+        encoded_bitarray.encode(self.codebook, symbols)
+        return encoded_bitarray
+
+    def decode(self, encoded_bitarray, num_symbols, offset=0):
+        """
+        Decode num_symbols symbols starting at encoded_bitarray[offset].
+        Returns the symbols and the number of bits they took.
+        """
+        if(num_symbols == 0):
+            return [], 0
+        bits = encoded_bitarray[offset:] if offset else encoded_bitarray
+        symbols = list(islice(canonical_decode(bits, self.count, self.symbols), num_symbols))
+        if(len(symbols) < num_symbols):
+            raise ValueError("reached end of bitarray")
+        return symbols, sum(self.lengths[symbol] for symbol in symbols)
+
+
 def test_encdec():
     # string = "aa bbb c"
     string = []
@@ -395,14 +564,76 @@ def test_encdec():
     print()
     symbols = []
     rx = huffman_adaptive_tree()
-    while(len(encoded_bitarray) > 0):
-        symbol, num_bits = rx.decode_symbol(encoded_bitarray)
+    offset = 0
+    while(offset < len(encoded_bitarray)):
+        symbol, num_bits = rx.decode_symbol(encoded_bitarray, offset)
         symbols.append(symbol)
-        encoded_bitarray = encoded_bitarray[num_bits:]
+        offset += num_bits
     print(string == symbols)
+
+
+def test_incremental():
+    # incremental mode has to produce exactly the same bits
+    string = [i % 7 for i in range(500)] + list(range(256))
+    tx = huffman_adaptive_tree()
+    tx_incremental = huffman_adaptive_tree(incremental=True)
+    same = True
+    for symbol in string:
+        same = same and (tx.encode_symbol(symbol) == tx_incremental.encode_symbol(symbol))
+    print(same and (tx.codebook == tx_incremental.codebook))
+
+
+def test_alphabet_size():
+    # 16 bit symbols, and an odd sized alphabet that gets exhausted
+    for alphabet_size, string in ((1 << 16, [(i * 7919) % (1 << 16) for i in range(300)] * 3 + [0xFFFF]),
+                                  (300, [(i * 7) % 300 for i in range(600)])):
+        tx = huffman_adaptive_tree(alphabet_size=alphabet_size, incremental=True)
+        encoded_bitarray = bitarray()
+        for symbol in string:
+            encoded_bitarray += tx.encode_symbol(symbol)
+        symbols = []
+        rx = huffman_adaptive_tree(alphabet_size=alphabet_size, incremental=True)
+        offset = 0
+        while(offset < len(encoded_bitarray)):
+            symbol, num_bits = rx.decode_symbol(encoded_bitarray, offset)
+            symbols.append(symbol)
+            offset += num_bits
+        print(string == symbols)
+
+
+def test_frozen():
+    # adaptive warm up, a frozen segment, then adaptive again
+    warm_up = list(b"abracadabra, abracadabra")
+    segment = list(b"cadabra abracad" * 20)
+    tail = list(b"zabracadabra")
+    tx = huffman_adaptive_tree(incremental=True)
+    encoded_bitarray = bitarray()
+    for symbol in warm_up:
+        encoded_bitarray += tx.encode_symbol(symbol)
+    encoded_bitarray += tx.freeze().encode(segment)
+    for symbol in tail:
+        encoded_bitarray += tx.encode_symbol(symbol)
+    rx = huffman_adaptive_tree(incremental=True)
+    symbols = []
+    offset = 0
+    for _ in warm_up:
+        symbol, num_bits = rx.decode_symbol(encoded_bitarray, offset)
+        symbols.append(symbol)
+        offset += num_bits
+    decoded, num_bits = rx.freeze().decode(encoded_bitarray, len(segment), offset)
+    symbols += decoded
+    offset += num_bits
+    while(offset < len(encoded_bitarray)):
+        symbol, num_bits = rx.decode_symbol(encoded_bitarray, offset)
+        symbols.append(symbol)
+        offset += num_bits
+    print(symbols == warm_up + segment + tail)
     
     
 if __name__ == "__main__":
     test_encdec()
+    test_incremental()
+    test_alphabet_size()
+    test_frozen()
     
     
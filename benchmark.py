@@ -0,0 +1,310 @@
+"""
+Benchmarks for both implementations and a static Huffman baseline on synthetic corpora.
+
+    python benchmark.py --sizes 1K 100K 1M --output results.json
+
+Every (implementation, corpus, size) case runs in its own process so peak RSS is per case. Corpora are generated from
+a fixed seed, so runs on different machines or commits see the same input. Results are written as JSON (meta data
+plus one record per case) for tracking regressions; a summary table goes to stderr.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import partial
+from bitarray import bitarray
+from adaptive_huffman_bfs import huffman_adaptive_tree
+from vitters_algorithm.compressor import AdaptiveHuffmanCompressor
+from vitters_algorithm.decompressor import AdaptiveHuffmanDecompress
+from vitters_algorithm import static
+
+CORPORA = ("uniform", "zipf", "english", "binary", "drift")
+IMPLEMENTATIONS = ("vitter", "vitter-aging", "bfs", "static")
+SEED = 274
+# Default for vitter-aging: all weights are halved after every this many symbols
+AGING_INTERVAL = 4096
+# The drift corpus changes its distribution every this many bytes
+DRIFT_SEGMENT = 16 << 10
+
+WORDS = ("the of and to a in is that for it as was with be by on not he this are or his from at which but have an they "
+         "you were her she there been one all we their has would when if so no will what more out up into do any about "
+         "time can only new some could these two may first then other like than now people my made over did down way "
+         "compression huffman adaptive tree node weight block leader symbol code stream algorithm vitter entropy").split()
+
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def generate(corpus, size, seed=SEED):
+    # Deterministic synthetic corpus of size bytes
+    rng = random.Random(f"{corpus}-{seed}")
+    if corpus == "uniform":
+        return rng.randbytes(size)
+    if corpus == "zipf":
+        weights = [1 / (rank + 1) ** 1.1 for rank in range(256)]
+        symbols = list(range(256))
+        rng.shuffle(symbols)
+        return bytes(rng.choices(symbols, weights, k=size))
+    if corpus == "english":
+        # Zipf distributed words with some punctuation and line breaks
+        weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+        out = bytearray()
+        while len(out) < size:
+            sentence = rng.choices(WORDS, weights, k=rng.randint(4, 18))
+            out += (" ".join(sentence).capitalize() + rng.choice((". ", ". ", ", ", "? ", ".\n"))).encode()
+        return bytes(out[:size])
+    if corpus == "binary":
+        # Fixed size records: small counters, timestamps, flags and floats, like a typical binary log
+        out = bytearray()
+        timestamp = 1_600_000_000_000
+        while len(out) < size:
+            timestamp += rng.randint(0, 5000)
+            out += timestamp.to_bytes(8, "little")
+            out += rng.randint(0, 300).to_bytes(4, "little")
+            out += bytes([rng.choice((0, 0, 0, 1, 3))])
+            out += int(rng.gauss(1 << 20, 1 << 12)).to_bytes(4, "little")
+            out += bytes(3)
+        return bytes(out[:size])
+    if corpus == "drift":
+        # Zipf distributed bytes like zipf, but which byte has which rank is reshuffled every DRIFT_SEGMENT bytes
+        weights = [1 / (rank + 1) ** 1.1 for rank in range(256)]
+        symbols = list(range(256))
+        out = bytearray()
+        while len(out) < size:
+            rng.shuffle(symbols)
+            out += bytes(rng.choices(symbols, weights, k=DRIFT_SEGMENT))
+        return bytes(out[:size])
+    raise ValueError(f"Unknown corpus {corpus}")
+
+
+def entropy(data):
+    # Order 0 entropy in bits per symbol
+    counts = Counter(data)
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in counts.values())
+
+
+def percentiles(samples_ns):
+    samples = sorted(samples_ns)
+    if not samples:
+        return None
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] / 1e3
+    return {"p50_us": pick(0.5), "p90_us": pick(0.9), "p99_us": pick(0.99), "p999_us": pick(0.999),
+            "max_us": samples[-1] / 1e3}
+
+
+# Every implementation has encode(data) -> (payload, bits), decode(payload, bits, n) -> bytes, and optionally
+# latency(data) -> (encode ns per symbol, decode ns per symbol). The payload is whatever the decoder needs.
+
+def vitter_encode(data, aging_interval=0):
+    out = bytearray()
+    num_bits = AdaptiveHuffmanCompressor(aging_interval=aging_interval).encode_bytes(data, out)
+    return out, num_bits
+
+
+def vitter_decode(payload, num_bits, num_symbols, aging_interval=0):
+    bits = bitarray()
+    bits.frombytes(payload)
+    out = bytearray()
+    AdaptiveHuffmanDecompress(aging_interval=aging_interval).decode(bits, 0, num_bits, out)
+    return bytes(out)
+
+
+def vitter_latency(data, aging_interval=0):
+    compressor = AdaptiveHuffmanCompressor(aging_interval=aging_interval)
+    codeword, update = compressor.codeword, compressor.update
+    clock = time.perf_counter_ns
+    encode_ns = []
+    for symbol in data:
+        start = clock()
+        codeword(symbol)
+        update(symbol)
+        encode_ns.append(clock() - start)
+    bits = bitarray()
+    bits.frombytes(vitter_encode(data, aging_interval)[0])
+    decompressor = AdaptiveHuffmanDecompress(aging_interval=aging_interval)
+    decode_ns = []
+    idx = 0
+    with memoryview(bits) as buf:
+        for _ in range(len(data)):
+            start = clock()
+            _, idx = decompressor._decode_symbol(bits, buf, idx, len(bits))
+            decode_ns.append(clock() - start)
+    return encode_ns, decode_ns
+
+
+def bfs_encode(data):
+    tree = huffman_adaptive_tree(incremental=True)
+    bits = bitarray()
+    for symbol in data:
+        bits += tree.encode_symbol(symbol)
+    return bits.tobytes(), len(bits)
+
+
+def bfs_decode(payload, num_bits, num_symbols):
+    bits = bitarray()
+    bits.frombytes(payload)
+    tree = huffman_adaptive_tree(incremental=True)
+    out = bytearray()
+    offset = 0
+    while offset < num_bits:
+        symbol, used = tree.decode_symbol(bits, offset)
+        out.append(symbol)
+        offset += used
+    return bytes(out)
+
+
+def bfs_latency(data):
+    tree = huffman_adaptive_tree(incremental=True)
+    clock = time.perf_counter_ns
+    encode_ns = []
+    bits = bitarray()
+    for symbol in data:
+        start = clock()
+        bits += tree.encode_symbol(symbol)
+        encode_ns.append(clock() - start)
+    tree = huffman_adaptive_tree(incremental=True)
+    decode_ns = []
+    offset = 0
+    while offset < len(bits) and len(decode_ns) < len(data):
+        start = clock()
+        _, used = tree.decode_symbol(bits, offset)
+        decode_ns.append(clock() - start)
+        offset += used
+    return encode_ns, decode_ns
+
+
+# Semi-static two pass Huffman coding (vitters_algorithm.static), the code table is part of the payload
+
+
+def static_encode(data):
+    return static.encode_block(data)
+
+
+def static_decode(payload, num_bits, num_symbols):
+    return bytes(static.decode_block(payload, num_bits, num_symbols))
+
+
+CODECS = {
+    "vitter": (vitter_encode, vitter_decode, vitter_latency),
+    # Same functions, run_case passes them the aging interval
+    "vitter-aging": (vitter_encode, vitter_decode, vitter_latency),
+    "bfs": (bfs_encode, bfs_decode, bfs_latency),
+    "static": (static_encode, static_decode, None),
+}
+
+
+def run_case(impl, corpus, size, latency_samples, aging_interval=AGING_INTERVAL):
+    # Runs in the child process
+    data = generate(corpus, size)
+    rss_corpus = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    encode, decode, latency = CODECS[impl]
+    if impl == "vitter-aging":
+        encode, decode, latency = (partial(f, aging_interval=aging_interval) for f in (encode, decode, latency))
+    start = time.perf_counter()
+    payload, num_bits = encode(data)
+    encode_s = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = decode(payload, num_bits, len(data))
+    decode_s = time.perf_counter() - start
+    if decoded != data:
+        raise AssertionError(f"{impl} round trip failed on {corpus} {size}")
+    result = {
+        "implementation": impl, "corpus": corpus, "size": size,
+        "encode_mb_s": size / encode_s / 1e6 if encode_s else None,
+        "decode_mb_s": size / decode_s / 1e6 if decode_s else None,
+        "encode_s": encode_s, "decode_s": decode_s,
+        "bits_per_symbol": num_bits / size if size else None,
+        "entropy_bits_per_symbol": entropy(data) if size else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "corpus_rss_kb": rss_corpus,
+    }
+    if impl == "vitter-aging":
+        result["aging_interval"] = aging_interval
+    if latency is not None and latency_samples:
+        encode_ns, decode_ns = latency(data[:latency_samples])
+        result["encode_latency"] = percentiles(encode_ns)
+        result["decode_latency"] = percentiles(decode_ns)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["1K", "10K", "100K"], help="corpus sizes, e.g. 1K 1M 100M")
+    parser.add_argument("--corpora", nargs="+", default=list(CORPORA), choices=CORPORA)
+    parser.add_argument("--implementations", nargs="+", default=list(IMPLEMENTATIONS), choices=IMPLEMENTATIONS)
+    parser.add_argument("--bfs-max-size", default="1M", help="skip the (slow) bfs implementation above this size")
+    parser.add_argument("--latency-samples", type=int, default=20000,
+                        help="symbols timed one at a time for the latency percentiles (0 to skip)")
+    parser.add_argument("--aging-interval", type=int, default=AGING_INTERVAL,
+                        help="symbols between halvings of all weights for vitter-aging")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        case = json.loads(args.run_case)
+        print(json.dumps(run_case(**case)))
+        return
+
+    bfs_max_size = parse_size(args.bfs_max_size)
+    results = []
+    for size in map(parse_size, args.sizes):
+        for corpus in args.corpora:
+            for impl in args.implementations:
+                if impl == "bfs" and size > bfs_max_size:
+                    continue
+                case = {"impl": impl, "corpus": corpus, "size": size, "latency_samples": args.latency_samples,
+                        "aging_interval": args.aging_interval}
+                child = subprocess.run([sys.executable, __file__, "--run-case", json.dumps(case)], capture_output=True,
+                                       text=True)
+                if child.returncode != 0:
+                    raise RuntimeError(f"{impl} {corpus} {size} failed:\n{child.stderr}")
+                result = json.loads(child.stdout)
+                results.append(result)
+                p99 = (result.get("encode_latency") or {}).get("p99_us")
+                print(f"{impl:>12} {corpus:>8} {size:>10}  enc {result['encode_mb_s'] or 0:7.3f} MB/s  "
+                      f"dec {result['decode_mb_s'] or 0:7.3f} MB/s  {result['bits_per_symbol'] or 0:6.3f} bits/sym "
+                      f"(entropy {result['entropy_bits_per_symbol'] or 0:.3f})  rss {result['peak_rss_kb']} KB"
+                      + (f"  enc p99 {p99:.1f} us" if p99 is not None else ""), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": SEED,
+            "aging_interval": args.aging_interval,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,174 @@
+"""
+Command line entry point.
+
+    python -m vitters_algorithm compress in.bin out.vhuf [--codec auto|adaptive|static] [--block-size 1048576]
+    python -m vitters_algorithm decompress out.vhuf in.bin
+
+The input is memory mapped and handed to the container coder a block at a time, and the output goes through a
+buffered writer into a file preallocated to a size hint (the exact size when decompressing, the input size or
+--size-hint when compressing) and trimmed to what was written, so files of any size are coded without reading them
+into memory. The sizes, ratio and throughput are printed to stderr at the end. A run that fails (e.g. on a corrupt
+container) removes the output (empties it if it was there before, leaves pipes and devices alone) and exits with
+status 1.
+"""
 import argparse
+import mmap
+import os
+import stat
+import sys
+import time
+import traceback
+from array import array
+from contextlib import contextmanager
 from bitarray import bitarray
+from .core import AdaptiveHuffman, symbol_typecode
 from .compressor import AdaptiveHuffmanCompressor
-from.decompressor import AdaptiveHuffmanDecompress
+from .decompressor import AdaptiveHuffmanDecompress
+from .container import CODECS, DEFAULT_BLOCK_SIZE, ContainerReader, ContainerWriter, pick_codec
+
+BUFFER_SIZE = 1 << 20
 
 
 def run_vitters(file_name):
-    compressor = AdaptiveHuffmanCompressor()
+    # Compress and decompress file_name (any bytes) in memory and check the round trip. Returns the number of bits.
+    with open(file_name, "rb") as f:
+        data = f.read()
+    out = bytearray()
+    num_bits = AdaptiveHuffmanCompressor().encode_bytes(data, out)
     stream = bitarray()
-    decompressor = AdaptiveHuffmanDecompress(stream=stream)
-    with open(file_name, "r") as f:
-        while True:     # Keep reading till EOF
-            next_char = f.read(1)
-            if next_char == "":
-                break
-            next_char_ascii = ord(next_char)
-            # print("Updating for "+str(next_char_ascii))
-            # print(f"Update complete from {next_char}, got value: {compressor.compress_update(next_char_ascii)}")
-            # print("-"*20)
-            node = compressor.representation[next_char_ascii]
-            bits = compressor.compress_update(next_char_ascii)
-            stream += bits
-            print(f"Sending over bits {bits} for {next_char}: {len(bits)}, node: {node}")
-            # import pdb; pdb.set_trace()
-    decompressor.decompress()
+    stream.frombytes(out)
+    del stream[num_bits:]
+    if AdaptiveHuffmanDecompress(stream=stream).decompress() != data:
+        raise ValueError(f"{file_name} didn't survive the round trip")
+    return num_bits
+
+
+@contextmanager
+def mapped(f):
+    # Read-only mmap of the whole file f, None if it is empty (those can't be mapped)
+    if os.fstat(f.fileno()).st_size == 0:
+        yield None
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if hasattr(data, "madvise"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            yield data
+        except BaseException as e:
+            # Slices of the mapping left in the locals of the frames the error came through would keep it from
+            # closing, and that BufferError would replace the error
+            traceback.clear_frames(e.__traceback__)
+            raise
+
+
+@contextmanager
+def output_file(path, size_hint):
+    # Buffered binary writer for path. A regular file is preallocated to size_hint bytes where the platform can and
+    # cut to what was written on the way out; if anything fails it is removed when this run created it (a
+    # preallocated file of the right size with a zero tail would look like a good result), emptied otherwise. Pipes
+    # and devices are just written to.
+    flags = os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    try:
+        fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o666)
+        created = True
+    except FileExistsError:
+        fd = os.open(path, flags | os.O_CREAT | os.O_TRUNC, 0o666)
+        created = False
+    f = open(fd, "wb", buffering=BUFFER_SIZE)
+    try:
+        regular = stat.S_ISREG(os.fstat(fd).st_mode)
+        if regular and size_hint > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size_hint)
+            except OSError:     # File systems without fallocate, or not enough space for the hint
+                pass
+        yield f
+        f.flush()
+        if regular:
+            f.truncate(f.tell())
+        f.close()
+    except BaseException:
+        try:
+            f.close()
+        except OSError:         # e.g. flushing the rest after running out of space, the first error is the one to report
+            pass
+        if created:
+            os.remove(path)
+        elif regular:
+            os.truncate(path, 0)
+        raise
+
+
+def compress(src, dst, codec="auto", block_size=DEFAULT_BLOCK_SIZE, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE,
+             size_hint=None):
+    # Returns (bytes read, bytes written)
+    with open(src, "rb") as f, mapped(f) as data:
+        size = len(data) if data is not None else 0
+        if codec == "auto":
+            codec = pick_codec(size)
+        with output_file(dst, size if size_hint is None else size_hint) as out:
+            with ContainerWriter(out, block_size=block_size, alphabet_size=alphabet_size, codec=codec) as writer:
+                if data is not None:
+                    writer.write(data)
+    return size, writer.bytes_written
+
+
+def decompress(src, dst, size_hint=None):
+    # Returns (bytes read, bytes written)
+    with open(src, "rb") as f, mapped(f) as data:
+        reader = ContainerReader(data if data is not None else f)
+        index = reader.index()
+        size = reader.num_symbols * array(symbol_typecode(reader.alphabet_size)).itemsize
+        written = 0
+        with output_file(dst, size if size_hint is None else size_hint) as out:
+            for info in index:
+                written += out.write(reader.read_block(info))
+        read = len(data) if data is not None else 0
+    return read, written
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--file-name", dest="file_name", help="file to compress", required=True)
+    parser = argparse.ArgumentParser(prog="python -m vitters_algorithm")
+    parser.add_argument("--file-name", dest="file_name", help="(legacy) compress and decompress a file in memory")
+    commands = parser.add_subparsers(dest="command")
+    compress_parser = commands.add_parser("compress", help="file to container")
+    compress_parser.add_argument("src")
+    compress_parser.add_argument("dst")
+    compress_parser.add_argument("--codec", choices=("auto",) + CODECS, default="auto",
+                                 help="auto: static for inputs of 64 KiB and more, adaptive otherwise")
+    compress_parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="symbols per block")
+    compress_parser.add_argument("--alphabet-size", type=int, default=AdaptiveHuffman.ALPHABET_SIZE)
+    decompress_parser = commands.add_parser("decompress", help="container to file")
+    decompress_parser.add_argument("src")
+    decompress_parser.add_argument("dst")
+    for command in (compress_parser, decompress_parser):
+        command.add_argument("--size-hint", type=int, default=None,
+                             help="bytes to preallocate for the output (default: input size / decoded size)")
     args = parser.parse_args()
-    run_vitters(args.file_name)
+    if args.command is None:
+        if args.file_name is None:
+            parser.error("a command (compress/decompress) is required")
+        try:
+            num_bits = run_vitters(args.file_name)
+        except (OSError, ValueError) as e:
+            parser.exit(1, f"{parser.prog}: error: {e}\n")
+        size = os.path.getsize(args.file_name)
+        print(f"{args.file_name}: {size} bytes -> {(num_bits + 7) // 8} bytes, round trip ok", file=sys.stderr)
+        sys.exit()
+
+    start = time.perf_counter()
+    try:
+        if args.command == "compress":
+            read, written = compress(args.src, args.dst, args.codec, args.block_size, args.alphabet_size,
+                                     args.size_hint)
+            uncompressed = read
+        else:
+            read, written = decompress(args.src, args.dst, args.size_hint)
+            uncompressed = written
+    except (OSError, ValueError) as e:
+        # ContainerError is a ValueError: a corrupt or truncated input
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    elapsed = time.perf_counter() - start
+    ratio = (written / read) if read else 0.0
+    print(f"{read} -> {written} bytes ({ratio:.3f}) in {elapsed:.2f}s, "
+          f"{uncompressed / max(elapsed, 1e-9) / 1e6:.2f} MB/s", file=sys.stderr)
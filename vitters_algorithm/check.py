@@ -0,0 +1,315 @@
+"""
+Invariant checker for the implicit tree and a differential fuzzer against adaptive_huffman_bfs.
+
+    python -m vitters_algorithm.check --cases 200 --max-length 20000 --check-every 1
+
+check_invariants() validates the whole state of a model: the alphabet/representation maps, the block list, the free
+list, and that the tree it describes has the sibling property. enable_checks() runs it after every update (or every
+k-th). fuzz() feeds random inputs to both implementations, compares the codeword length of every symbol (escapes by
+the length of the path to the 0-node, the index bits after it are coded differently), round trips both, and checks
+the leaf weights against the symbol counts. With --aging every case halves its weights now and then (a random
+aging_interval, max_weight and/or max_depth on both sides), which the bfs version can't follow, so those cases are
+checked by the invariants and the round trip.
+"""
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+from bitarray import bitarray
+from bitarray.util import int2ba
+from .core import AdaptiveHuffman, NO_PARENT
+from .compressor import AdaptiveHuffmanCompressor
+from .decompressor import AdaptiveHuffmanDecompress
+
+
+class InvariantError(AssertionError):
+    pass
+
+
+def _fail(message):
+    raise InvariantError(message)
+
+
+def check_invariants(model: AdaptiveHuffman, counts=None):
+    """
+    Raise InvariantError if the state of model is inconsistent. With counts (alphabet index -> number of updates),
+    also check that every seen letter's leaf has that weight.
+    """
+    try:
+        _check(model, counts)
+    except (IndexError, KeyError) as e:
+        # Indexes that point outside the arrays or at nodes that aren't in the tree
+        raise InvariantError(f"Dangling index: {e!r}") from e
+
+
+def _check(model, counts):
+    n = model.ALPHABET_SIZE
+    Z = model.NUM_NODES_POSSIBLE
+    M = model.M
+
+    # M = 2^E + R with 0 <= R < 2^E
+    if M > 0 and not (M == (1 << model.E) + model.R and 0 <= model.R < (1 << model.E)):
+        _fail(f"M={M} E={model.E} R={model.R} break M = 2^E + R")
+    # alphabet and representation are inverse permutations
+    for node in range(n):
+        if model.representation[model.alphabet[node]] != node:
+            _fail(f"representation[alphabet[{node}]] != {node}")
+
+    # Live nodes: leaves M-1 (the 0-node) to n-1, and one internal node fewer than leaves from the root down
+    if M == n:
+        root = n-1
+        live = [n-1]
+    else:
+        num_leaves = n - max(M-1, 0)
+        root = Z-1
+        live = list(range(max(M-1, 0), n)) + list(range(Z - (num_leaves-1), Z))
+
+    # Block list: circular and doubly linked, every live node in the block that claims it, ordered by (weight, leaves
+    # before internal nodes), and the root's block is the last one
+    first = model.next_block[model.block[root]]
+    block = first
+    seen_blocks = []
+    position = {}
+    previous_key = None
+    while True:
+        if len(seen_blocks) > Z:
+            _fail("Block list doesn't cycle back to its start")
+        if model.prev_block[model.next_block[block]] != block:
+            _fail(f"prev_block[next_block[{block}]] != {block}")
+        leader, last = model.leader_node[block], model.last_node[block]
+        if last > leader or (last < n <= leader):
+            _fail(f"Block {block} runs from {last} to {leader}")
+        key = (model.weight[block], leader >= n)
+        if previous_key is not None and key <= previous_key:
+            _fail(f"Block {block} (weight, internal) {key} doesn't come after {previous_key}")
+        previous_key = key
+        for node in range(last, leader+1):
+            if model.block[node] != block:
+                _fail(f"Node {node} is in block {model.block[node]}, block {block} holds {last}..{leader}")
+            position[node] = len(position)
+        seen_blocks.append(block)
+        block = model.next_block[block]
+        if block == first:
+            break
+    if sorted(position) != sorted(live):
+        _fail(f"Blocks hold {len(position)} nodes, the tree has {len(live)}")
+    if position[root] != len(position)-1:
+        _fail("Root isn't the last node in the block order")
+
+    # Free list: every block that isn't in use, each once
+    in_use = set(seen_blocks)
+    free = set()
+    block = model.available_block
+    for _ in range(Z - len(in_use)):
+        if block in in_use or block in free or not 0 <= block < Z:
+            _fail(f"Free list reaches block {block}, which is in use, repeated or out of range")
+        free.add(block)
+        block = model.next_block[block]
+
+    # The tree: every non-root node's parent has it as a child, siblings are next to each other in the block order
+    # (the sibling property), internal nodes weigh what their children do and come after them
+    weight = lambda node: model.weight[model.block[node]]
+    children = Counter()
+    for node in live:
+        if node == root:
+            continue
+        parent = model.find_parent(node)
+        if parent not in position or parent < n:
+            _fail(f"Parent of {node} is {parent}, not a live internal node")
+        children[parent] += 1
+        # The bit the compressor sends for this step has to lead the decompressor back here
+        node_block = model.block[node]
+        bit = (model.leader_node[node_block] - node + model.parity[node_block]) & 1
+        if model.find_child(parent, bit) != node:
+            _fail(f"Node {node} is child {bit} of {parent} going up, {model.find_child(parent, bit)} going down")
+    for node in live:
+        if node < n:
+            continue
+        left, right = model.find_child(node, 0), model.find_child(node, 1)
+        if left not in position or right not in position:
+            _fail(f"Children of {node} are {left}, {right}")
+        if model.find_parent(left) != node or model.find_parent(right) != node or children[node] != 2:
+            _fail(f"Node {node} has children {left}, {right} but they don't have it as their parent")
+        if position[right] != position[left] + 1:
+            _fail(f"Children {left}, {right} of {node} aren't siblings in the block order")
+        if position[node] <= position[right]:
+            _fail(f"Node {node} comes before its child {right}")
+        if weight(node) != weight(left) + weight(right):
+            _fail(f"Node {node} weighs {weight(node)}, its children {weight(left)} + {weight(right)}")
+    if M > 0 and weight(M-1) != 0:
+        _fail("The 0-node has weight")
+    if M < n and model.parent[model.block[root]] != NO_PARENT:
+        _fail("Root has a parent")
+
+    if counts is not None:
+        for letter, count in counts.items():
+            node = model.representation[letter]
+            if node <= M-1 or weight(node) != count:
+                _fail(f"Letter {letter} was seen {count} times, its leaf {node} weighs {weight(node)}")
+
+
+def enable_checks(model: AdaptiveHuffman, every=1):
+    # Check the invariants (and the letter counts) after every every-th update of model. Returns the counts.
+    update = model.update
+    age = model.age
+    counts = Counter()
+    updates = 0
+
+    def checked_update(alphabet_idx):
+        nonlocal updates
+        # Counted first, update() ages after adding the symbol
+        counts[alphabet_idx] += 1
+        update(alphabet_idx)
+        updates += 1
+        if updates % every == 0:
+            check_invariants(model, counts)
+
+    def counted_age():
+        age()
+        for letter, count in counts.items():
+            counts[letter] = (count+1) // 2
+
+    model.update = checked_update
+    model.age = counted_age
+    return counts
+
+
+def random_input(rng, max_length, alphabet_size=256):
+    # Inputs that exercise different parts of the tree: few or all letters, skewed, runs, and late new letters
+    length = rng.randrange(1, max_length+1)
+    kind = rng.choice(("uniform", "small", "zipf", "runs", "sweep", "late"))
+    if kind == "uniform":
+        return [rng.randrange(alphabet_size) for _ in range(length)], kind
+    if kind == "small":
+        letters = rng.sample(range(alphabet_size), rng.randint(1, 4))
+        return [rng.choice(letters) for _ in range(length)], kind
+    if kind == "zipf":
+        letters = rng.sample(range(alphabet_size), alphabet_size)
+        weights = [1 / (rank+1) ** rng.uniform(0.5, 2) for rank in range(alphabet_size)]
+        return rng.choices(letters, weights, k=length), kind
+    if kind == "runs":
+        out = []
+        while len(out) < length:
+            out += [rng.randrange(alphabet_size)] * rng.randint(1, 50)
+        return out[:length], kind
+    if kind == "sweep":
+        # Every letter, so the 0-node goes away
+        letters = list(range(alphabet_size))
+        rng.shuffle(letters)
+        return letters + [rng.randrange(alphabet_size) for _ in range(length)], kind
+    # Mostly a few letters with a new one now and then
+    letters = [rng.randrange(alphabet_size)]
+    out = []
+    for _ in range(length):
+        if rng.random() < 0.01:
+            letters.append(rng.randrange(alphabet_size))
+        out.append(rng.choice(letters))
+    return out, kind
+
+
+def random_options(rng, alphabet_size=256):
+    # Model options that make it age now and then: an aging_interval, a low max_weight, a max_depth or all three
+    kind = rng.choice(("interval", "weight", "depth", "all"))
+    options = {}
+    if kind in ("interval", "all"):
+        options["aging_interval"] = rng.randint(1, 500)
+    if kind in ("weight", "all"):
+        options["max_weight"] = rng.randint(2*alphabet_size + 1, 4000)
+    if kind in ("depth", "all"):
+        options["max_depth"] = rng.randint(alphabet_size.bit_length() + 1, 20)
+    return options
+
+
+def run_case(symbols, check_every=1, compare_bfs=True, options=None):
+    """
+    Returns None if everything agreed, otherwise a description of the first problem. options (e.g. from
+    random_options) go to both the compressor and the decompressor; the bfs version doesn't age, so it is only compared
+    against without them.
+    """
+    from adaptive_huffman_bfs import huffman_adaptive_tree
+
+    options = options or {}
+    compressor = AdaptiveHuffmanCompressor(**options)
+    counts = enable_checks(compressor, check_every) if check_every else None
+    tree = huffman_adaptive_tree(incremental=True) if compare_bfs and not options else None
+    stream = bitarray()
+    reference = bitarray()
+    for i, symbol in enumerate(symbols):
+        node = compressor.representation[symbol]
+        escape = node <= compressor.M-1
+        index_bits = 0
+        if escape:
+            index_bits = compressor.E+1 if node < 2*compressor.R else compressor.E
+        code, length = compressor.codeword(symbol)
+        try:
+            compressor.update(symbol)
+        except InvariantError as e:
+            return f"symbol {i} ({symbol}): {e}"
+        if length:
+            stream += int2ba(code, length)
+        if tree is not None:
+            bits = tree.encode_symbol(symbol)
+            reference += bits
+            bfs_index_bits = tree.symbol_bits if escape else 0
+            if length - index_bits != len(bits) - bfs_index_bits:
+                return f"symbol {i} ({symbol}): codeword {length - index_bits} bits, bfs has {len(bits) - bfs_index_bits}"
+    if check_every:
+        try:
+            check_invariants(compressor, counts)
+        except InvariantError as e:
+            return f"at the end: {e}"
+
+    decompressor = AdaptiveHuffmanDecompress(stream=stream, **options)
+    try:
+        decoded = decompressor.decompress()
+    except (ValueError, IndexError) as e:
+        return f"decoding failed: {e!r}"
+    if list(decoded) != list(symbols):
+        return "round trip differs"
+    if tree is not None:
+        tree = huffman_adaptive_tree(incremental=True)
+        offset = 0
+        decoded = []
+        while offset < len(reference):
+            symbol, used = tree.decode_symbol(reference, offset)
+            decoded.append(symbol)
+            offset += used
+        if decoded != list(symbols):
+            return "bfs round trip differs"
+    return None
+
+
+def fuzz(cases, max_length, seed=0, check_every=1, compare_bfs=True, aging=False, log=sys.stderr):
+    # Returns a list of (case, kind, input, problem) for the failing cases. With aging every case gets random_options.
+    rng = random.Random(seed)
+    failures = []
+    total = 0
+    start = time.perf_counter()
+    for case in range(cases):
+        symbols, kind = random_input(rng, max_length)
+        options = random_options(rng) if aging else None
+        if options:
+            kind = f"{kind}, {', '.join(f'{name}={value}' for name, value in options.items())}"
+        total += len(symbols)
+        problem = run_case(symbols, check_every, compare_bfs, options)
+        if problem is not None:
+            failures.append((case, kind, symbols, problem))
+            print(f"case {case} ({kind}, {len(symbols)} symbols): {problem}", file=log)
+    elapsed = time.perf_counter() - start
+    print(f"{cases} cases, {total} symbols, {len(failures)} failures in {elapsed:.1f}s", file=log)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Differential fuzzer for vitters_algorithm")
+    parser.add_argument("--cases", type=int, default=100)
+    parser.add_argument("--max-length", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check-every", type=int, default=1, help="check invariants every k updates (0: never)")
+    parser.add_argument("--no-bfs", action="store_true", help="only round trip, don't compare against the bfs version")
+    parser.add_argument("--aging", action="store_true",
+                        help="random aging_interval/max_weight/max_depth per case (round trip and invariants only)")
+    args = parser.parse_args()
+    failures = fuzz(args.cases, args.max_length, args.seed, args.check_every, not args.no_bfs, args.aging)
+    sys.exit(1 if failures else 0)
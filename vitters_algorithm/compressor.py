@@ -1,62 +1,152 @@
-from .core import AdaptiveHuffman
+from typing import Tuple
+from .core import AdaptiveHuffman, NO_PARENT
 from bitarray import bitarray
+from bitarray.util import int2ba
 
 
 class AdaptiveHuffmanCompressor(AdaptiveHuffman):
-    def __init__(self):
-        super().__init__()
+    # Codewords longer than this aren't cached
+    CACHE_MAX_LENGTH = 64
 
-    def compress(self, alphabet_idx):
-        # node is implicitly an index
-        node = self.representation[alphabet_idx]
-        stack = bitarray()
-        if node <= self.M-1:        # If node is unseen before this point
-            # Special logic for transmitting (we don't have to do -1 like in original paper because Python is 0-indexed
-            # unlike scala)
-            num_bits = -1
-            if node < 2*self.R:
-                num_bits = self.E+1
-            else:
-                node -= self.R
-                num_bits = self.E
-            # Get the base 2 representation of (potentially modified) node
-            for i in range(num_bits):
-                stack += "1" if node & 1 else "0"
-                node = node >> 1
-            # We need to transfer over the location of the NYT node so decompressor knows this is a new letter
-            node = self.M-1
+    def __init__(self, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE, compact=False, aging_interval=0,
+                 max_weight=AdaptiveHuffman.MAX_WEIGHT, max_depth=0):
+        super().__init__(alphabet_size=alphabet_size, compact=compact, aging_interval=aging_interval,
+                         max_weight=max_weight, max_depth=max_depth)
+        # Codeword cache for seen letters: leaf node -> (codeword, length). A leaf's codeword only depends on the shape
+        # of the tree, so it is keyed by leaf rather than letter (interchanging leaves doesn't invalidate anything) and
+        # entries are only dropped when a slide rewires one of their ancestors (see before_slide).
+        self.codewords = {}
+        self._ancestors = {}    # Cached leaf -> the nodes on its path
+        self._below = {}        # Node -> cached leaves below it
+        # Bits encode_bytes produced that don't make up a whole byte yet
+        self._acc = 0
+        self._acc_bits = 0
+
+    def reset(self):
+        super().reset()
+        self._acc = self._acc_bits = 0
+
+    def _clear_caches(self):
+        self.codewords.clear()
+        self._ancestors.clear()
+        self._below.clear()
+
+    def path(self, node, ancestors=None) -> Tuple[int, int]:
+        # Path from the root to node as (bits, number of bits), first step in the most significant bit. The nodes
+        # passed on the way up are appended to ancestors if given.
         # If this is the first letter we are seeing
-        root = -1
         if self.M == self.ALPHABET_SIZE:
             root = self.ALPHABET_SIZE-1
         else:
             root = self.NUM_NODES_POSSIBLE-1
-        # Traverse up the tree and append to attack
+        code = 0
+        length = 0
+        # Traverse up the tree
         while node != root:
-            # print(self.block, node)
             node_block = self.block[node]
             # Made this part a little easier to understand than in the paper
             # Since the tree is balanced, you can figure out your direction (i.e. left or right) depending on the leader
-            # of your block;s direction
+            # of your block's direction: same as the leader if an even number of nodes away from it, opposite otherwise
             leader_node_implicit_diff = self.leader_node[node_block] - node
-            # print(leader_node_implicit_diff)
-            leader_direction = self.parity[node_block]
-            if leader_node_implicit_diff % 2 == 0:   # Same as leader
-                stack += "1" if leader_direction else "0"
-            else:                               # Different from leader
-                stack += "0" if leader_direction else "1"
-            # print(f"Leader of {node} is {self.leader_node[node_block]}")
-            # Update the node (i.e. set node to parent of current node)
-            leader_parent = self.parent[node_block]
-            # print(node_block, self.block[508], self.block[509], self.block[510], self.weight[self.block[510]])
+            code |= ((leader_node_implicit_diff + self.parity[node_block]) & 1) << length
+            length += 1
             # Intuition: For every 2 movements from leader to node, we have 1 movement from parent to node's parent
             # because balanced tree
             leader_parent_node_parent_implicit_diff = (leader_node_implicit_diff + (1-self.parity[node_block])) // 2
-            node = leader_parent - leader_parent_node_parent_implicit_diff
-            # print(f"Walking up {node}")
-            # print(leader_node_implicit_diff, leader_parent_node_parent_implicit_diff)
-        stack.reverse()
-        return stack
+            node = self.parent[node_block] - leader_parent_node_parent_implicit_diff
+            if ancestors is not None:
+                ancestors.append(node)
+        return code, length
+
+    def codeword(self, alphabet_idx) -> Tuple[int, int]:
+        # Codeword for alphabet_idx as (bits, number of bits), doesn't update the tree
+        # node is implicitly an index
+        node = self.representation[alphabet_idx]
+        if node > self.M-1:
+            entry = self.codewords.get(node)
+            if entry is None:
+                ancestors = []
+                entry = self.path(node, ancestors)
+                if entry[1] <= self.CACHE_MAX_LENGTH:
+                    self.codewords[node] = entry
+                    self._ancestors[node] = ancestors
+                    for ancestor in ancestors:
+                        below = self._below.get(ancestor)
+                        if below is None:
+                            self._below[ancestor] = {node}
+                        else:
+                            below.add(node)
+            return entry
+        # If node is unseen before this point, we send the path to the NYT node followed by the letter's index
+        # Special logic for transmitting (we don't have to do -1 like in original paper because Python is 0-indexed
+        # unlike scala)
+        if node < 2*self.R:
+            num_bits = self.E+1
+        else:
+            node -= self.R
+            num_bits = self.E
+        code, length = self.path(self.M-1)
+        return (code << num_bits) | (node & ((1 << num_bits)-1)), length+num_bits
+
+    def before_slide(self, node_parent, next_block):
+        if self.codewords:
+            # Drop the cached leaves below the nodes whose children are about to change
+            changed = list(range(self.find_parent(self.last_node[next_block]), self.parent[next_block]+1))
+            if node_parent != NO_PARENT:
+                changed.append(node_parent)
+            for node in changed:
+                leaves = self._below.pop(node, None)
+                if leaves is None:
+                    continue
+                for leaf in leaves:
+                    del self.codewords[leaf]
+                    for ancestor in self._ancestors.pop(leaf):
+                        if ancestor != node:
+                            self._below[ancestor].discard(leaf)
+        super().before_slide(node_parent, next_block)
+
+    def encode_bytes(self, buf, out: bytearray, final=True) -> int:
+        """
+        Encode and update for every symbol in buf (bytes/memoryview, or any sequence of ints for larger alphabets),
+        appending the code to out. Returns the number of bits the symbols took.
+
+        The bits are collected in an integer and moved to out a machine word or so at a time, nothing is allocated per
+        symbol. With final=False the last bits that don't fill a byte are held back and go in front of the next call's;
+        with final=True they are written out zero padded.
+        """
+        if isinstance(buf, str):
+            # Iterating a str gives characters, not byte values; the caller has to pick an encoding
+            raise TypeError("encode_bytes takes bytes or a sequence of ints, not str")
+        codeword = self.codeword
+        update = self.update
+        acc = self._acc
+        acc_bits = self._acc_bits
+        written = 0
+        for symbol in buf:
+            code, length = codeword(symbol)
+            update(symbol)
+            acc = (acc << length) | code
+            acc_bits += length
+            written += length
+            if acc_bits >= 64:
+                # Move the whole bytes out, keep the bits that don't make up a byte yet
+                keep = acc_bits & 7
+                out += (acc >> keep).to_bytes(acc_bits >> 3, "big")
+                acc &= (1 << keep)-1
+                acc_bits = keep
+        keep = acc_bits & 7
+        out += (acc >> keep).to_bytes(acc_bits >> 3, "big")
+        acc &= (1 << keep)-1
+        if final and keep:
+            out.append(acc << (8-keep))
+            acc = keep = 0
+        self._acc = acc
+        self._acc_bits = keep
+        return written
+
+    def compress(self, alphabet_idx):
+        code, length = self.codeword(alphabet_idx)
+        return int2ba(code, length) if length else bitarray()
 
     def compress_update(self, alphabet_idx):
         ret = self.compress(alphabet_idx)
@@ -0,0 +1,550 @@
+"""
+Self-describing container around the adaptive Huffman codec.
+
+Layout (all integers little endian):
+
+    file header   magic "VHUF" | version u16 | alphabet size u32 | block size u32 | codec u8 (version 3 on)
+    block         number of symbols u32 | number of bits u64 | crc32 of payload u32 | payload
+    ...
+    end block     0 u32 | 0 u64 | 0 u32
+    trailer       total number of symbols u64
+    index entry   symbol offset u64 | number of symbols u32 | number of bits u64 | crc32 u32 | payload offset u64
+    ...
+    index footer  number of blocks u32 | offset of the first index entry u64 | magic "VIDX"
+
+Every block is coded on its own: with a fresh adaptive model, or (codec "static") with a canonical Huffman code for
+its counts whose table leads the payload (see static.py). The payload holds ceil(bits / 8) bytes; the
+bit count says where the zero padding in the final byte starts. The end block and trailer tell a complete stream from
+a truncated one, and the block headers are enough to validate (crc32 of the payload) and skip blocks without decoding.
+The index (version 2 on) repeats the block headers with their positions, offsets relative to the start of the
+container, so a reader that can seek finds the blocks covering any range of symbols without scanning the file.
+Block sizes and symbol counts are in symbols; for alphabets larger than 256 each symbol is 2 (or 4) bytes of the
+uncompressed stream, little endian.
+"""
+import io
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+from typing import Iterator, List, NamedTuple, Tuple
+from .core import AdaptiveHuffman, symbol_typecode
+from .decompressor import AdaptiveHuffmanDecompress
+from .stream import AdaptiveHuffmanWriter, CHUNK_SIZE
+from . import static
+
+MAGIC = b"VHUF"
+FORMAT_VERSION = 3
+INDEX_MAGIC = b"VIDX"
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+HEADER = struct.Struct("<4sHII")
+CODEC = struct.Struct("<B")
+BLOCK_HEADER = struct.Struct("<IQI")
+TRAILER = struct.Struct("<Q")
+INDEX_ENTRY = struct.Struct("<QIQIQ")
+INDEX_FOOTER = struct.Struct("<IQ4s")
+
+# Codec names, stored as their position here
+CODECS = ("adaptive", "static")
+# codec="auto" picks static from this many bytes of input on: the code table costs about as much as the adaptive
+# model takes to learn the statistics by then, and static coding is two orders of magnitude faster
+AUTO_STATIC_SIZE = 64 << 10
+
+
+class ContainerError(ValueError):
+    pass
+
+
+class BlockInfo(NamedTuple):
+    index: int
+    offset: int             # Offset of the block's first symbol in the uncompressed stream
+    num_symbols: int
+    num_bits: int
+    crc: int
+    file_offset: int        # Offset of the block's payload in the container
+
+    @property
+    def payload_size(self):
+        return (self.num_bits + 7) // 8
+
+
+def encode_block(data, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    # Code data with a fresh model, returns (payload, number of meaningful bits)
+    payload = io.BytesIO()
+    with AdaptiveHuffmanWriter(payload, alphabet_size=alphabet_size) as writer:
+        writer.write(data)
+    return payload.getvalue(), writer.bits_written
+
+
+def decode_block(payload, num_bits, num_symbols, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    decompressor = AdaptiveHuffmanDecompress(alphabet_size=alphabet_size)
+    out = bytearray()
+    for block in decompressor.decompress_chunks([payload], num_bits=num_bits):
+        out += block
+    itemsize = array(decompressor.symbol_typecode).itemsize
+    if len(out) != num_symbols * itemsize:
+        raise ContainerError(f"Block decoded to {len(out) // itemsize} symbols, header says {num_symbols}")
+    return out
+
+
+# codec -> (encode_block, decode_block)
+BLOCK_CODERS = {
+    "adaptive": (encode_block, decode_block),
+    "static": (static.encode_block, static.decode_block),
+}
+
+
+def pick_codec(size):
+    # The codec "auto" stands for, given the input size in bytes (None if it isn't known)
+    return "static" if size is not None and size >= AUTO_STATIC_SIZE else "adaptive"
+
+
+def input_size(src):
+    # Bytes left in the binary file object src if that can be told without reading it, otherwise None
+    try:
+        return os.fstat(src.fileno()).st_size - src.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    if hasattr(src, "seekable") and src.seekable():
+        position = src.tell()
+        size = src.seek(0, io.SEEK_END) - position
+        src.seek(position)
+        return size
+    return None
+
+
+class ContainerWriter(io.RawIOBase):
+    """
+    File-like object that writes everything written to it into dst as a container, one block per block_size symbols,
+    each coded with codec ("adaptive" or "static").
+
+    The end block and trailer are written on close (dst itself is not closed). Leaving a with block on an exception
+    aborts instead, so an interrupted container can't pass for a complete one.
+    """
+    def __init__(self, dst, block_size=DEFAULT_BLOCK_SIZE, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE,
+                 codec="adaptive"):
+        super().__init__()
+        if block_size <= 0 or block_size > 0xFFFFFFFF:
+            raise ValueError(f"Invalid block size {block_size}")
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}")
+        self.codec = codec
+        self._encode_block = BLOCK_CODERS[codec][0]
+        self.dst = dst
+        self.block_size = block_size
+        self.alphabet_size = alphabet_size
+        self._itemsize = array(symbol_typecode(alphabet_size)).itemsize
+        self._block_bytes = block_size * self._itemsize
+        self.num_symbols = 0
+        self.num_blocks = 0
+        self._pending = bytearray()
+        self._index = []        # BlockInfo per block, file offsets relative to the start of the container
+        self.dst.write(HEADER.pack(MAGIC, FORMAT_VERSION, alphabet_size, block_size))
+        self.dst.write(CODEC.pack(CODECS.index(codec)))
+        self._offset = HEADER.size + CODEC.size
+
+    def writable(self):
+        return True
+
+    @property
+    def bytes_written(self):
+        # Size of the container written to dst so far (all of it once closed), for a dst that can't tell()
+        return self._offset
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed ContainerWriter")
+        data = memoryview(data).cast("B")
+        start = 0
+        if not self._pending:
+            # Whole blocks straight from data (e.g. an mmap), without copying them through the buffer
+            while len(data) - start >= self._block_bytes:
+                self._write_block(data[start:start + self._block_bytes])
+                start += self._block_bytes
+        self._pending += data[start:]
+        while len(self._pending) >= self._block_bytes:
+            block = self._pending[:self._block_bytes]
+            del self._pending[:self._block_bytes]
+            self._write_block(block)
+        return len(data)
+
+    def _write_block(self, data):
+        payload, num_bits = self._encode_block(data, self.alphabet_size)
+        self._append_block(len(data) // self._itemsize, payload, num_bits)
+
+    def write_encoded_block(self, num_symbols, payload, num_bits):
+        # Append a block that was already coded with this writer's codec (e.g. in another process). Anything passed to write()
+        # and not flushed as a block yet would end up after it, so the two can't be mixed.
+        if self.closed:
+            raise ValueError("write to closed ContainerWriter")
+        if self._pending:
+            raise ValueError("write_encoded_block with unflushed write() data")
+        self._append_block(num_symbols, payload, num_bits)
+
+    def _append_block(self, num_symbols, payload, num_bits):
+        crc = zlib.crc32(payload)
+        self.dst.write(BLOCK_HEADER.pack(num_symbols, num_bits, crc))
+        self.dst.write(payload)
+        self._offset += BLOCK_HEADER.size
+        self._index.append(BlockInfo(self.num_blocks, self.num_symbols, num_symbols, num_bits, crc, self._offset))
+        self._offset += len(payload)
+        self.num_symbols += num_symbols
+        self.num_blocks += 1
+
+    def abort(self):
+        # Close without the end block, trailer and index: what was written so far reads as a truncated container
+        self._pending = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc, traceback):
+        # An error in the with block mustn't end the container, that would pass the blocks before it off as all of it
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._pending:
+                block, self._pending = self._pending, bytearray()
+                self._write_block(block)
+            self.dst.write(BLOCK_HEADER.pack(0, 0, 0))
+            self.dst.write(TRAILER.pack(self.num_symbols))
+            index_offset = self._offset + BLOCK_HEADER.size + TRAILER.size
+            self.dst.write(b"".join(INDEX_ENTRY.pack(info.offset, info.num_symbols, info.num_bits, info.crc,
+                                                     info.file_offset) for info in self._index))
+            self.dst.write(INDEX_FOOTER.pack(len(self._index), index_offset, INDEX_MAGIC))
+            self._offset = index_offset + len(self._index) * INDEX_ENTRY.size + INDEX_FOOTER.size
+            if hasattr(self.dst, "flush"):
+                self.dst.flush()
+        finally:
+            super().close()
+
+
+class ContainerReader:
+    """
+    Reads a container from the binary file object src. Blocks can be listed, validated and decoded one at a time;
+    payloads of blocks that aren't needed are skipped (with seek() if src supports it). If src can seek and the
+    container runs to its end, index() and read_range() go straight to the blocks they need.
+    """
+    def __init__(self, src):
+        self.src = src
+        # mmap objects seek but only have seekable() from Python 3.13
+        self._seekable = src.seekable() if hasattr(src, "seekable") else isinstance(src, mmap.mmap)
+        self._start = src.tell() if self._seekable else 0
+        header = self._read_exact(HEADER.size)
+        magic, self.version, self.alphabet_size, self.block_size = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ContainerError("Not a VHUF container")
+        if not 1 <= self.version <= FORMAT_VERSION:
+            raise ContainerError(f"Unsupported container version {self.version}")
+        if self.alphabet_size < 2:
+            raise ContainerError(f"Invalid alphabet size {self.alphabet_size}")
+        self._header_size = HEADER.size
+        self.codec = "adaptive"
+        if self.version >= 3:
+            (codec,) = CODEC.unpack(self._read_exact(CODEC.size))
+            if codec >= len(CODECS):
+                raise ContainerError(f"Unknown codec {codec}")
+            self.codec = CODECS[codec]
+            self._header_size += CODEC.size
+        self._decode_block = BLOCK_CODERS[self.codec][1]
+        self._itemsize = array(symbol_typecode(self.alphabet_size)).itemsize
+        self._position = self._header_size    # Only used to report file offsets when src can't tell us
+        self.num_symbols = None         # Known once the trailer was read
+        self._index = None
+
+    def _read_exact(self, size):
+        data = self.src.read(size)
+        if len(data) != size:
+            raise ContainerError("Truncated container")
+        return data
+
+    def _tell(self):
+        return self.src.tell() if self._seekable else self._position
+
+    def _skip(self, size):
+        if self._seekable:
+            self.src.seek(size, io.SEEK_CUR)
+        else:
+            self._read_exact(size)
+        self._position += size
+
+    def _read_payload(self, info):
+        payload = self._read_exact(info.payload_size)
+        self._position += len(payload)
+        if zlib.crc32(payload) != info.crc:
+            raise ContainerError(f"CRC mismatch in block {info.index}")
+        return payload
+
+    def _headers(self, read_payload) -> Iterator:
+        # Yields (BlockInfo, payload or None) and checks the end block, trailer and index
+        index = 0
+        offset = 0
+        entries = []
+        while True:
+            num_symbols, num_bits, crc = BLOCK_HEADER.unpack(self._read_exact(BLOCK_HEADER.size))
+            self._position += BLOCK_HEADER.size
+            if num_symbols == 0:
+                if num_bits or crc:
+                    raise ContainerError("Corrupt end block")
+                break
+            info = BlockInfo(index, offset, num_symbols, num_bits, crc, self._tell())
+            entries.append(INDEX_ENTRY.pack(offset, num_symbols, num_bits, crc, info.file_offset - self._start))
+            if read_payload:
+                yield info, self._read_payload(info)
+            else:
+                self._skip(info.payload_size)
+                yield info, None
+            index += 1
+            offset += num_symbols
+        (total,) = TRAILER.unpack(self._read_exact(TRAILER.size))
+        self._position += TRAILER.size
+        if total != offset:
+            raise ContainerError(f"Trailer says {total} symbols, blocks hold {offset}")
+        if self.version >= 2:
+            index_offset = self._tell() - self._start
+            if self._read_exact(len(entries) * INDEX_ENTRY.size) != b"".join(entries):
+                raise ContainerError("Block index doesn't match the blocks")
+            footer = INDEX_FOOTER.pack(len(entries), index_offset, INDEX_MAGIC)
+            if self._read_exact(INDEX_FOOTER.size) != footer:
+                raise ContainerError("Corrupt block index footer")
+            self._position += len(entries) * INDEX_ENTRY.size + INDEX_FOOTER.size
+        self.num_symbols = total
+
+    def index(self) -> List[BlockInfo]:
+        """
+        Every block's BlockInfo, in order. Read from the index at the end of the container if src can seek (src has
+        to end with the container then), otherwise by going over the block headers, which consumes src.
+
+        Like read_block() and read_range(), this moves the position of a seekable src.
+        """
+        if self._index is None:
+            if self._seekable and self.version >= 2:
+                self._index = self._read_index()
+            else:
+                if self._seekable:
+                    self.src.seek(self._start + self._header_size)
+                self._index = list(self.blocks())
+            self._offsets = [info.offset for info in self._index]
+        return self._index
+
+    def _read_index(self):
+        self.src.seek(-INDEX_FOOTER.size, io.SEEK_END)
+        num_blocks, index_offset, magic = INDEX_FOOTER.unpack(self._read_exact(INDEX_FOOTER.size))
+        if magic != INDEX_MAGIC or index_offset < self._header_size + BLOCK_HEADER.size + TRAILER.size:
+            raise ContainerError("Missing or corrupt block index")
+        # The trailer is right before the index
+        self.src.seek(self._start + index_offset - TRAILER.size)
+        (total,) = TRAILER.unpack(self._read_exact(TRAILER.size))
+        data = self._read_exact(num_blocks * INDEX_ENTRY.size)
+        index = []
+        offset = 0
+        for i, (symbol_offset, num_symbols, num_bits, crc, file_offset) in enumerate(INDEX_ENTRY.iter_unpack(data)):
+            if symbol_offset != offset or num_symbols == 0:
+                raise ContainerError(f"Corrupt block index entry {i}")
+            index.append(BlockInfo(i, symbol_offset, num_symbols, num_bits, crc, self._start + file_offset))
+            offset += num_symbols
+        if total != offset:
+            raise ContainerError(f"Trailer says {total} symbols, index holds {offset}")
+        self.num_symbols = total
+        return index
+
+    def read_range(self, offset, length) -> bytes:
+        # Symbols offset to offset+length of the uncompressed stream, only decoding the blocks that hold them
+        index = self.index()
+        if offset < 0 or length < 0 or offset + length > self.num_symbols:
+            raise ValueError(f"Range {offset}+{length} is outside the {self.num_symbols} symbols in the container")
+        out = bytearray()
+        end = offset + length
+        i = bisect_right(self._offsets, offset) - 1
+        while offset < end:
+            info = index[i]
+            block = self.read_block(info)
+            start = offset - info.offset
+            stop = min(end - info.offset, info.num_symbols)
+            out += block[start*self._itemsize:stop*self._itemsize]
+            offset = info.offset + stop
+            i += 1
+        return bytes(out)
+
+    def blocks(self) -> Iterator[BlockInfo]:
+        # List the blocks without reading their payloads
+        for info, _ in self._headers(read_payload=False):
+            yield info
+
+    def payloads(self) -> Iterator[Tuple[BlockInfo, bytes]]:
+        # (BlockInfo, payload) per block with its crc checked but not decoded, e.g. to decode them elsewhere
+        return self._headers(read_payload=True)
+
+    def verify(self) -> int:
+        # Check every block's crc without decoding anything. Returns the number of symbols in the stream.
+        for _ in self._headers(read_payload=True):
+            pass
+        return self.num_symbols
+
+    def __iter__(self) -> Iterator[bytearray]:
+        # Decoded blocks in order
+        for info, payload in self._headers(read_payload=True):
+            yield self._decode(info, payload)
+
+    def read_block(self, info: BlockInfo) -> bytearray:
+        # Decode a single block listed by blocks() or index() (src has to be seekable)
+        self.src.seek(info.file_offset)
+        return self._decode(info, self._read_payload(info))
+
+    def _decode(self, info, payload):
+        # A payload that passed its crc can still disagree with a corrupt header (e.g. its symbol count)
+        try:
+            return self._decode_block(payload, info.num_bits, info.num_symbols, self.alphabet_size)
+        except ContainerError:
+            raise
+        except (ValueError, IndexError) as e:
+            raise ContainerError(f"Block {info.index} doesn't decode: {e}") from e
+
+
+def compress_file(src, dst, block_size=DEFAULT_BLOCK_SIZE, chunk_size=CHUNK_SIZE,
+                  alphabet_size=AdaptiveHuffman.ALPHABET_SIZE, codec="adaptive"):
+    # Returns the number of symbols written. codec "auto" picks by the size of src (adaptive if it can't be told).
+    if codec == "auto":
+        codec = pick_codec(input_size(src))
+    with ContainerWriter(dst, block_size=block_size, alphabet_size=alphabet_size, codec=codec) as writer:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+    return writer.num_symbols
+
+
+def decompress_file(src, dst):
+    # Returns the number of symbols written
+    reader = ContainerReader(src)
+    for block in reader:
+        dst.write(block)
+    return reader.num_symbols
+
+
+def _older_version(container, version):
+    # container (version 3, starting at offset 0) rewritten as version 1 (no codec byte, no index) or 2 (no codec byte)
+    magic, _, alphabet_size, block_size = HEADER.unpack_from(container)
+    num_blocks, index_offset, _ = INDEX_FOOTER.unpack_from(container, len(container) - INDEX_FOOTER.size)
+    body = container[HEADER.size + CODEC.size:index_offset]
+    older = HEADER.pack(magic, version, alphabet_size, block_size) + body
+    if version >= 2:
+        entries = container[index_offset:len(container) - INDEX_FOOTER.size]
+        for symbol_offset, num_symbols, num_bits, crc, file_offset in INDEX_ENTRY.iter_unpack(entries):
+            older += INDEX_ENTRY.pack(symbol_offset, num_symbols, num_bits, crc, file_offset - CODEC.size)
+        older += INDEX_FOOTER.pack(num_blocks, index_offset - CODEC.size, INDEX_MAGIC)
+    return older
+
+
+def test_round_trip():
+    # Both codecs, byte and wide alphabets, a container that doesn't start at offset 0 and versions 1 to 3
+    import random
+    rng = random.Random(3)
+    prefix = b"not part of the container"
+    ok = True
+    for codec in CODECS:
+        for alphabet_size in (256, 300):
+            itemsize = array(symbol_typecode(alphabet_size)).itemsize
+            symbols = rng.choices(range(alphabet_size), range(alphabet_size, 0, -1), k=5000)
+            data = b"".join(symbol.to_bytes(itemsize, "little") for symbol in symbols)
+            container = io.BytesIO()
+            compress_file(io.BytesIO(data), container, block_size=700, alphabet_size=alphabet_size, codec=codec)
+            container = container.getvalue()
+            versions = [container] + ([_older_version(container, 1), _older_version(container, 2)]
+                                      if codec == "adaptive" else [])
+            for version in versions:
+                src = io.BytesIO(prefix + version)
+                src.seek(len(prefix))
+                reader = ContainerReader(src)
+                ok = ok and reader.codec == codec and reader.alphabet_size == alphabet_size
+                out = io.BytesIO()
+                for block in reader:
+                    out.write(block)
+                ok = ok and out.getvalue() == data and reader.num_symbols == len(data) // itemsize
+                src.seek(len(prefix))
+                reader = ContainerReader(src)
+                for _ in range(20):
+                    offset = rng.randrange(len(data) // itemsize)
+                    length = rng.randrange(len(data) // itemsize - offset + 1)
+                    ok = ok and reader.read_range(offset, length) == data[offset*itemsize:(offset+length)*itemsize]
+    print(ok)
+
+
+def test_corruption():
+    # Truncating the container anywhere, or flipping a bit anywhere after the file header, is a ContainerError. (The
+    # alphabet and block size in the header aren't checked by anything.)
+    import random
+    rng = random.Random(21)
+    data = bytes(rng.choices(b"abcdefgh ", k=3000))
+    ok = True
+    for codec in CODECS:
+        container = io.BytesIO()
+        compress_file(io.BytesIO(data), container, block_size=1000, codec=codec)
+        container = container.getvalue()
+        for end in range(len(container)):
+            try:
+                ContainerReader(io.BytesIO(container[:end])).verify()
+                ok = False
+            except ContainerError:
+                pass
+        for position in range(HEADER.size + CODEC.size, len(container)):
+            for bit in (0, rng.randrange(8)):
+                corrupt = bytearray(container)
+                corrupt[position] ^= 1 << bit
+                try:
+                    ContainerReader(io.BytesIO(corrupt)).verify()
+                    ok = False
+                except ContainerError:
+                    pass
+        # Decoding hits the same checks
+        for position in rng.sample(range(HEADER.size + CODEC.size, len(container)), 20):
+            corrupt = bytearray(container)
+            corrupt[position] ^= 0x10
+            try:
+                decompress_file(io.BytesIO(corrupt), io.BytesIO())
+                ok = False
+            except ContainerError:
+                pass
+    # A source failing part way leaves a container without its end block and index, not a shorter valid one
+    class FailingSource(io.RawIOBase):
+        reads = 0
+        def readable(self):
+            return True
+        def readinto(self, buffer):
+            self.reads += 1
+            if self.reads == 3:
+                raise OSError("read failed")
+            buffer[:1000] = data[:1000]
+            return min(len(buffer), 1000)
+    for codec in CODECS:
+        container = io.BytesIO()
+        try:
+            compress_file(FailingSource(), container, block_size=1000, chunk_size=1000, codec=codec)
+            ok = False
+        except OSError:
+            pass
+        try:
+            ContainerReader(io.BytesIO(container.getvalue())).verify()
+            ok = False
+        except ContainerError:
+            pass
+    for header in (HEADER.pack(b"VHUG", FORMAT_VERSION, 256, 1000), HEADER.pack(MAGIC, FORMAT_VERSION+1, 256, 1000),
+                   HEADER.pack(MAGIC, 0, 256, 1000), HEADER.pack(MAGIC, FORMAT_VERSION, 256, 1000) + CODEC.pack(9)):
+        try:
+            ContainerReader(io.BytesIO(header))
+            ok = False
+        except ContainerError:
+            pass
+    print(ok)
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_corruption()
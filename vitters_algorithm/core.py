@@ -1,85 +1,340 @@
-from typing import List, Union
-import traceback
-
-class CustomList(list):
-    def __init__(self, iterable):
-        super().__init__(item for item in iterable)
-
-    def __getitem__(self, idx):
-        # print(f"Get requested on {idx}")
-        # traceback.print_stack(limit=2)
-        return super().__getitem__(idx)
-
-    def __setitem__(self, key, value):
-        # print(f"Set requested on {key} with value {value}")
-        # traceback.print_stack(limit=2)
-        return super().__setitem__(key, value)
-
-# Set requested on 0 with value 255
-# Set requested on 1 with value 510
-# Set requested on 2 with value 509
+import struct
+import sys
+from array import array
+from itertools import chain
+from typing import Iterable, List
+
+# Parent of the root. The state can live in typed arrays so this can't be None.
+NO_PARENT = -1
+
+# Names of the per letter and per node/block arrays, in the order they are laid out in the compact state
+LETTER_FIELDS = ("alphabet", "representation")
+NODE_FIELDS = ("block", "weight", "parent", "parity", "right_child", "leader_node", "last_node", "prev_block",
+               "next_block")
+
+# Snapshot blob: magic | version | alphabet size | M | E | R | available block | updates until the next aging, then
+# every state array as little endian int32 in LETTER_FIELDS + NODE_FIELDS order. Version 1 had no aging count.
+SNAPSHOT_MAGIC = b"VHMS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHIIIiII")
+SNAPSHOT_HEADER_V1 = struct.Struct("<4sHIIIiI")
+
+
+def symbol_typecode(alphabet_size):
+    # Smallest array typecode that holds every symbol of the alphabet. Streams of symbols wider than a byte are laid out
+    # little endian with this width.
+    for typecode in ("B", "H", "I"):
+        if alphabet_size <= 1 << (8*array(typecode).itemsize):
+            return typecode
+    raise ValueError(f"Alphabet size {alphabet_size} is too large")
+
+
+def symbols_from_bytes(data, typecode):
+    # The symbols in data laid out as above: a memoryview of data itself for bytes, an array otherwise
+    if typecode == "B":
+        return memoryview(data).cast("B")
+    symbols = array(typecode)
+    symbols.frombytes(data)
+    if sys.byteorder == "big":
+        symbols.byteswap()
+    return symbols
 
 
 class AdaptiveHuffman:
-    # aka n in original paper
+    # aka n in original paper. This is the default, instances can use any size >= 2 (see __init__)
     ALPHABET_SIZE = 256
     # Aka Z in original paper
     NUM_NODES_POSSIBLE = 2 * ALPHABET_SIZE - 1  # In the case of a completely balanced tree
-
-    def __init__(self):
+    # Default max_weight: the root's weight stays within an int32 (the compact state). A Huffman tree needs a total
+    # weight of at least Fibonacci(d+2) for a leaf at depth d, so this also keeps every path under 46 edges (one more
+    # for the 0-node), i.e. codewords for byte alphabets fit a 64 bit word with the escape index.
+    MAX_WEIGHT = (1 << 31) - 1
+
+    def __init__(self, alphabet_size=ALPHABET_SIZE, compact=False, aging_interval=0, max_weight=MAX_WEIGHT,
+                 max_depth=0):
+        if alphabet_size < 2:
+            raise ValueError(f"Alphabet size has to be at least 2, got {alphabet_size}")
+        if aging_interval < 0:
+            raise ValueError(f"aging_interval can't be negative, got {aging_interval}")
+        # Halving has to bring the tree back under both, or every update would rescale
+        if max_weight <= 2*alphabet_size:
+            raise ValueError(f"max_weight has to be more than twice the alphabet size, got {max_weight}")
+        # Weights are stored as int32 in the compact state and in snapshots
+        if max_weight > self.MAX_WEIGHT:
+            raise ValueError(f"max_weight can be at most {self.MAX_WEIGHT}, got {max_weight}")
+        if max_depth and max_depth <= alphabet_size.bit_length():
+            raise ValueError(f"max_depth has to be more than {alphabet_size.bit_length()}, got {max_depth}")
+        self.ALPHABET_SIZE = alphabet_size
+        self.NUM_NODES_POSSIBLE = 2 * alphabet_size - 1
         # Init all data structures to 0s initially
-        self.alphabet: List[int] = [0] * self.ALPHABET_SIZE          # Node value to alphabet index mapping (i.e. ascii value)
-        self.representation: List[int] = [0] * self.ALPHABET_SIZE    # Alphabet index to node value mapping
-
-        self.block: List[int] = [0] * self.NUM_NODES_POSSIBLE
-
-        self.weight: List[int] = [0] * self.NUM_NODES_POSSIBLE
-        self.parent: List[Union[int, None]] = [0] * self.NUM_NODES_POSSIBLE
-        # self.parent = CustomList([0]*self.NUM_NODES_POSSIBLE)
-        self.parity: List[int] = [0] * self.NUM_NODES_POSSIBLE
-        # self.right_child: List[Union[int, None]] = [0] * self.NUM_NODES_POSSIBLE
-        self.right_child: List[int] = CustomList([0]*self.NUM_NODES_POSSIBLE)
-        # aka first node in original paper
-        self.leader_node: List[int] = [0] * self.NUM_NODES_POSSIBLE
-        # self.leader_node: List[int] = CustomList([0]*self.NUM_NODES_POSSIBLE)
-        self.last_node: List[int] = [0] * self.NUM_NODES_POSSIBLE
-        self.prev_block: List[int] = [0] * self.NUM_NODES_POSSIBLE
-        # self.prev_block: List[int] = CustomList([0] * self.NUM_NODES_POSSIBLE)
-        self.next_block: List[int] = [0] * self.NUM_NODES_POSSIBLE
-        self.available_block: int = 0
-
-        # Maintained such that M = 2^E+R
-        self.M = 0      # This holds the number of unseen elements of alphabet
-        self.E = 0
-        self.R = -1
-        # Get correct values for M, R and E (could also use a log2)
-        for i in range(self.ALPHABET_SIZE):
-            self.M += 1
-            self.R += 1
-            # Reached point where residual is equal to 2^E
-            if 2*self.R == self.M:
-                self.E += 1
-                self.R = 0
-
-        # Set initial mapping to be the identity mapping
-        for i in range(self.ALPHABET_SIZE):
-            self.alphabet[i] = i
-            self.representation[i] = i
-
-        # Initialize n'th node as NYT (0-node)
-        # Bug, was 1, needs to be 0 because of 0 indexing
-        self.block[self.ALPHABET_SIZE-1] = 0
-        self.prev_block[0] = 0
-        self.next_block[0] = 0
-        self.weight[0] = 0
-        self.leader_node[0] = self.ALPHABET_SIZE-1
-        self.last_node[0] = self.ALPHABET_SIZE-1
-        self.parity[0] = 0
-        self.parent[0] = None
+        # alphabet: Node value to alphabet index mapping (i.e. ascii value)
+        # representation: Alphabet index to node value mapping
+        # leader_node: aka first node in original paper
+        self.alphabet: List[int]
+        self.representation: List[int]
+        self.block: List[int]
+        self.weight: List[int]
+        self.parent: List[int]
+        self.parity: List[int]
+        self.right_child: List[int]
+        self.leader_node: List[int]
+        self.last_node: List[int]
+        self.prev_block: List[int]
+        self.next_block: List[int]
+        # Halve all weights (see age()) after every this many updates, 0 never does. Encoder and decoder have to agree.
+        self.aging_interval = aging_interval
+        # Also halve once the root weighs max_weight, or an update walks a path of more than max_depth nodes (0: no
+        # limit), so counts can't overflow however long the stream is. max_weight is at most MAX_WEIGHT (weights are
+        # int32 in the compact state and in snapshots) and bounds every codeword; max_depth only looks at the symbols
+        # being coded, leaves that don't come up can stay a few levels deeper.
+        self.max_weight = max_weight
+        self.max_depth = max_depth
+        # Copy the initial state from the template for this alphabet, building it the first time
+        template = self._template(alphabet_size, compact)
+        if compact:
+            # Every array is a view on its own slice of one contiguous int32 buffer. Half the size of lists of ints
+            # and the whole state can be copied/snapshotted in one go, but every access is slower than a list's.
+            self.state = array("i", template)
+            view = memoryview(self.state)
+            offset = 0
+            for name in LETTER_FIELDS + NODE_FIELDS:
+                size = self.ALPHABET_SIZE if name in LETTER_FIELDS else self.NUM_NODES_POSSIBLE
+                setattr(self, name, view[offset:offset+size])
+                offset += size
+        else:
+            self.state = None
+            for name in LETTER_FIELDS + NODE_FIELDS:
+                setattr(self, name, template[name][:])
+        self._reset_counters()
+
+    # Initial state per (alphabet size, compact): a dict of lists, or the whole compact state in one array
+    _templates = {}
+
+    @staticmethod
+    def _template(alphabet_size, compact):
+        template = AdaptiveHuffman._templates.get((alphabet_size, compact))
+        if template is None:
+            num_nodes = 2 * alphabet_size - 1
+            template = {name: [0] * alphabet_size for name in LETTER_FIELDS}
+            template.update((name, [0] * num_nodes) for name in NODE_FIELDS)
+            # Set initial mapping to be the identity mapping
+            template["alphabet"][:] = range(alphabet_size)
+            template["representation"][:] = range(alphabet_size)
+            # Initialize n'th node as NYT (0-node)
+            # Bug, was 1, needs to be 0 because of 0 indexing
+            template["block"][alphabet_size-1] = 0
+            template["leader_node"][0] = alphabet_size-1
+            template["last_node"][0] = alphabet_size-1
+            template["parent"][0] = NO_PARENT
+            # Chain all other blocks into the list of available blocks
+            template["next_block"][:] = range(1, num_nodes+1)
+            template["next_block"][0] = 0
+            template["next_block"][num_nodes-1] = 0
+            if compact:
+                template = array("i", chain.from_iterable(template[name] for name in LETTER_FIELDS + NODE_FIELDS))
+            AdaptiveHuffman._templates[alphabet_size, compact] = template
+        return template
+
+    def _reset_counters(self):
         self.available_block = 1
-        for i in range(self.available_block, self.NUM_NODES_POSSIBLE-1):
-            self.next_block[i] = i+1
-        self.next_block[self.NUM_NODES_POSSIBLE-1] = 0
+        # Maintained such that M = 2^E+R (with 0 <= R < 2^E)
+        self.M = self.ALPHABET_SIZE     # This holds the number of unseen elements of alphabet
+        self.E = self.M.bit_length() - 1
+        self.R = self.M - (1 << self.E)
+        # Bumped whenever the shape of the tree changes (a slide or a new node). Weight changes and leaf interchanges
+        # don't change which node is whose child, so anything derived from the shape alone stays valid until this moves.
+        self.topology_version = 0
+        self._schedule_aging()
+
+    def _schedule_aging(self):
+        # Number of updates until update() ages next: aging_interval, or when the root (which every update adds one to)
+        # reaches max_weight, whichever is first
+        root_weight = self.weight[self.block[self.NUM_NODES_POSSIBLE-1]] if self.M < self.ALPHABET_SIZE else 0
+        self.updates_to_aging = self.max_weight - root_weight
+        if self.aging_interval:
+            self.updates_to_aging = min(self.updates_to_aging, self.aging_interval)
+
+    # Derived rather than stored: CPython makes attribute access slower on instances with more than about 30 attributes,
+    # and update() reads a lot of them
+    @property
+    def compact(self):
+        return self.state is not None
+
+    @property
+    def symbol_typecode(self):
+        return symbol_typecode(self.ALPHABET_SIZE)
+
+    def reset(self):
+        # Back to the initial state without allocating anything, so a context can be reused for the next message
+        template = self._template(self.ALPHABET_SIZE, self.compact)
+        if self.compact:
+            memoryview(self.state)[:] = template
+        else:
+            for name in LETTER_FIELDS + NODE_FIELDS:
+                getattr(self, name)[:] = template[name]
+        self._reset_counters()
+        self._clear_caches()
+
+    def _clear_caches(self):
+        # Called when the whole state is replaced (reset/restore/age). Subclasses drop whatever they derived from it.
+        pass
+
+    def snapshot(self) -> bytes:
+        """
+        The full model as a byte blob that restore() (or from_snapshot()) takes back, on any machine. About 20 KB for
+        256 symbols: every state array as int32, including the unused parts.
+        """
+        state = self.state if self.compact else array("i", chain.from_iterable(getattr(self, name)
+                                                                              for name in LETTER_FIELDS + NODE_FIELDS))
+        if sys.byteorder == "big":
+            state = array("i", state)
+            state.byteswap()
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.ALPHABET_SIZE, self.M, self.E, self.R,
+                                      self.available_block, self.updates_to_aging)
+        return header + state.tobytes()
+
+    def restore(self, blob) -> None:
+        # Replace the model with one from snapshot(). The alphabet size has to match this instance's.
+        magic, version = struct.unpack_from("<4sH", blob)
+        if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+            raise ValueError("Not an AdaptiveHuffman snapshot")
+        header = SNAPSHOT_HEADER if version == SNAPSHOT_VERSION else SNAPSHOT_HEADER_V1
+        _, _, alphabet_size, M, E, R, available_block, *rest = header.unpack_from(blob)
+        updates_to_aging = rest[0] if rest else 0
+        if alphabet_size != self.ALPHABET_SIZE:
+            raise ValueError(f"Snapshot is for {alphabet_size} symbols, this model has {self.ALPHABET_SIZE}")
+        state = array("i")
+        state.frombytes(memoryview(blob)[header.size:])
+        if len(state) != len(LETTER_FIELDS)*self.ALPHABET_SIZE + len(NODE_FIELDS)*self.NUM_NODES_POSSIBLE:
+            raise ValueError("Truncated snapshot")
+        if sys.byteorder == "big":
+            state.byteswap()
+        if self.compact:
+            memoryview(self.state)[:] = state
+        else:
+            offset = 0
+            for name in LETTER_FIELDS + NODE_FIELDS:
+                size = self.ALPHABET_SIZE if name in LETTER_FIELDS else self.NUM_NODES_POSSIBLE
+                getattr(self, name)[:] = state[offset:offset+size]
+                offset += size
+        self.M, self.E, self.R, self.available_block = M, E, R, available_block
+        self._schedule_aging()
+        if updates_to_aging:
+            self.updates_to_aging = updates_to_aging
+        self.topology_version += 1
+        self._clear_caches()
+
+    @classmethod
+    def from_snapshot(cls, blob, **kwargs):
+        # New instance of cls (e.g. a compressor or decompressor) starting from a snapshot, kwargs go to the constructor
+        alphabet_size = SNAPSHOT_HEADER.unpack_from(blob)[2]
+        model = cls(alphabet_size=alphabet_size, **kwargs)
+        model.restore(blob)
+        return model
+
+    def train(self, symbols: Iterable[int]):
+        """
+        Update the model with every symbol of a sample corpus (e.g. bytes) without coding anything. Encoder and decoder
+        both starting from the trained model (see snapshot()) skip the warm up where most symbols are still escapes.
+        Returns self.
+        """
+        update = self.update
+        for symbol in symbols:
+            update(symbol)
+        return self
+
+    def age(self):
+        """
+        Halve the weight of every seen letter (rounding up, so none of them becomes unseen) and rebuild the tree for
+        the new weights, so the recent past counts as much as everything before it. Done every aging_interval updates
+        if that is set, and whenever max_weight or max_depth is reached; encoder and decoder have to age at the same
+        points.
+
+        Halving keeps the leaves in the order they already are in, so there is nothing to sort and no letter moves: the
+        leaves are merged Huffman style with a second queue for the internal nodes (taking the leaf on ties), and the
+        order nodes leave the queues in is the implicit numbering, from which the blocks are laid out directly.
+        """
+        n = self.ALPHABET_SIZE
+        Z = self.NUM_NODES_POSSIBLE
+        if self.M == n:
+            self._schedule_aging()
+            return
+        # Leaves are numbered in block order, so this is from the lightest up, starting with the 0-node if there is one
+        leaf_base = max(self.M-1, 0)
+        weights = [(self.weight[self.block[node]]+1) // 2 for node in range(leaf_base, n)]
+        num_leaves = len(weights)
+        # Merge: internal node j gets order positions 2j and 2j+1 as its children
+        order = []          # Implicit numbering from the bottom, leaves as node numbers, internal nodes as Z+j
+        internal = []       # Weight of internal node j
+        leaf = 0
+        for j in range(num_leaves-1):
+            weight = 0
+            for _ in range(2):
+                if leaf < num_leaves and (len(order)-leaf >= j or weights[leaf] <= internal[len(order)-leaf]):
+                    order.append(leaf_base+leaf)
+                    weight += weights[leaf]
+                    leaf += 1
+                else:
+                    weight += internal[len(order)-leaf]
+                    order.append(Z+len(order)-leaf)
+            internal.append(weight)
+        order.append(Z+num_leaves-2)
+        # Internal node j is node Z-num_leaves+1+j, the root is Z-1
+        internal_base = Z-num_leaves+1
+        for i, node in enumerate(order):
+            if node >= Z:
+                order[i] = internal_base + node-Z
+        # Blocks: runs of the order with the same weight and kind, numbered from the bottom
+        block = -1
+        previous = None
+        for position, node in enumerate(order):
+            weight = weights[node-leaf_base] if node < n else internal[node-internal_base]
+            if (weight, node >= n) != previous:
+                previous = weight, node >= n
+                block += 1
+                self.weight[block] = weight
+                self.last_node[block] = node
+            self.block[node] = block
+            self.leader_node[block] = node
+            # The leader is the last node of its run, so these end up describing it
+            if node == Z-1:
+                self.parent[block] = NO_PARENT
+                self.parity[block] = 0
+            else:
+                self.parent[block] = internal_base + position//2
+                self.parity[block] = position & 1
+            if node >= n:
+                self.right_child[block] = order[2*(node-internal_base)+1]
+        num_blocks = block+1
+        for block in range(num_blocks):
+            self.next_block[block] = block+1 if block+1 < num_blocks else 0
+            self.prev_block[block] = block-1 if block else num_blocks-1
+        # Everything else goes back on the free list
+        for block in range(num_blocks, Z):
+            self.next_block[block] = block+1 if block+1 < Z else 0
+        self.available_block = num_blocks if num_blocks < Z else 0
+        self._schedule_aging()
+        self.topology_version += 1
+        self._clear_caches()
+
+    def enable_stats(self):
+        """
+        Start counting what update() does on this instance: new symbols, slide_and_increment calls per symbol, slides,
+        block allocations/frees/merges, find_child calls, the longest codeword and the tree depth (see stats.py).
+        Returns the UpdateStats being filled in. Models that don't enable stats pay nothing for them.
+        """
+        from .stats import instrument
+        self.disable_stats()
+        self.stats = instrument(self)
+        return self.stats
+
+    def disable_stats(self):
+        # Put back the methods enable_stats() wrapped, including wrappers that were already there (see check.py)
+        stats = getattr(self, "stats", None)
+        if stats is not None:
+            from .stats import uninstrument
+            uninstrument(self, stats)
+        self.stats = None
 
     def interchange_leaves(self, node1, node2):
         # BUG THIS WAS WRONG
@@ -115,6 +370,7 @@ class AdaptiveHuffman:
             # self.leader_node[node_block] = self.M
             # Leader is now on the right (leader is the newly created 0-weight node)
             self.parity[node_block] = 1
+            self.topology_version += 1
             # Now, create parent @ M+n for these 2 nodes
             new_block = self.available_block
             self.available_block = self.next_block[self.available_block]
@@ -185,9 +441,10 @@ class AdaptiveHuffman:
             self.weight[node_block] + 1 == self.weight[next_block]):
             # print("here")
             to_slide = True
+            self.before_slide(node_parent, next_block)
             old_parent = self.parent[next_block]
             old_parity = self.parity[next_block]
-            if node_parent is not None:
+            if node_parent != NO_PARENT:
                 parent_block = self.block[node_parent]
                 if self.right_child[parent_block] == node:
                     self.right_child[parent_block] = self.last_node[next_block]
@@ -213,8 +470,10 @@ class AdaptiveHuffman:
 
         # If leaf and next block is a leaf block or internal node and next next block is an internal node block
         # HUGE BUG, 12/16, DIDN'T HAVE THE FINAL CONDITION, WAS SEEING WEIRD RESULTS
-        if (node < self.ALPHABET_SIZE and self.leader_node[next_block] < self.ALPHABET_SIZE) or \
-                (node >= self.ALPHABET_SIZE and self.leader_node[next_block] >= self.ALPHABET_SIZE) \
+        # Bug fix: the weight check only bound to the internal node case (and binds tighter than or), so leaves were
+        # being merged into leaf blocks of any weight. This is what broke larger files.
+        if ((node < self.ALPHABET_SIZE and self.leader_node[next_block] < self.ALPHABET_SIZE) or
+                (node >= self.ALPHABET_SIZE and self.leader_node[next_block] >= self.ALPHABET_SIZE)) \
                 and (self.weight[next_block] == self.weight[node_block]+1):
             # print(f"INTERNAL AND NEXT IS INTERNAL OR LEAF AND NEXT IS LEAF: {node} {self.weight[self.block[node]]}")
             self.block[node] = next_block
@@ -292,6 +551,17 @@ class AdaptiveHuffman:
         # print("Slide and increment after", self.leader_node)
         return node
 
+    def before_slide(self, node_parent, next_block):
+        # Called right before the leader of a block slides over next_block. The only nodes whose children change are
+        # the slider's parent (node_parent) and the parents of the nodes in next_block. Subclasses that cache anything
+        # derived from the shape of the tree can hook in here to drop just what those nodes affect.
+        self.topology_version += 1
+
+    def find_parent(self, node):
+        # Same arithmetic the compressor uses to walk up the tree
+        node_block = self.block[node]
+        return self.parent[node_block] - (self.leader_node[node_block] - node + 1 - self.parity[node_block]) // 2
+
     def find_child(self, node, direction):
         delta = 2*(self.leader_node[self.block[node]]-node) + 1 - direction
         right = self.right_child[self.block[node]]
@@ -315,10 +585,15 @@ class AdaptiveHuffman:
         # print(f"Update on {alphabet_idx}")
         node, leaf_to_increment = self.get_leaf(alphabet_idx)
         # print(f"UPDATE GOING THROUGH FOR NODE {node}, {leaf_to_increment}")
-        while node is not None:
+        depth = 0
+        while node != NO_PARENT:
             node = self.slide_and_increment(node)
+            depth += 1
         if leaf_to_increment is not None:
             node = self.slide_and_increment(leaf_to_increment)
+        self.updates_to_aging -= 1
+        if not self.updates_to_aging or (self.max_depth and depth > self.max_depth):
+            self.age()
 
 
 
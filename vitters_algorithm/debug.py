@@ -1,3 +1,23 @@
+import traceback
+
+
+# Drop-in replacement for any of AdaptiveHuffman's state lists to trace accesses to it while debugging, e.g.
+# model.right_child = CustomList(model.right_child)
+class CustomList(list):
+    def __init__(self, iterable):
+        super().__init__(item for item in iterable)
+
+    def __getitem__(self, idx):
+        # print(f"Get requested on {idx}")
+        # traceback.print_stack(limit=2)
+        return super().__getitem__(idx)
+
+    def __setitem__(self, key, value):
+        # print(f"Set requested on {key} with value {value}")
+        # traceback.print_stack(limit=2)
+        return super().__setitem__(key, value)
+
+
 def print_before_and_after(**identifiers):
     def wrapper(func):
         def f(*args, **kwargs):
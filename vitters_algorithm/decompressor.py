@@ -1,64 +1,234 @@
-from .core import AdaptiveHuffman
+import sys
+from array import array
+from typing import Iterable, Iterator, Optional, Tuple
+from bitarray import bitarray
+from bitarray.util import ba2int
+from .core import AdaptiveHuffman, NO_PARENT
 
 
-class CompletedException(Exception):
-    pass
+def read_bits(bits, buf, idx, count) -> int:
+    # bits[idx:idx+count] as an integer, first bit most significant. buf is a memoryview of bits (or None): whole bytes
+    # are converted at once rather than bit by bit.
+    if buf is None:
+        return ba2int(bits[idx:idx+count]) if count else 0
+    first = idx >> 3
+    last = (idx+count+7) >> 3
+    value = int.from_bytes(buf[first:last], "big")
+    return (value >> ((last << 3) - idx - count)) & ((1 << count)-1)
+
+
+def big_endian(bits):
+    # bits itself if it is big endian, otherwise a big endian copy holding the same bits. read_bits and the decode
+    # tables take the first bit of a byte as its most significant one.
+    endian = bits.endian
+    if (endian() if callable(endian) else endian) == "big":     # A method before bitarray 3
+        return bits
+    return bitarray(bits, endian="big")
 
 
 class AdaptiveHuffmanDecompress(AdaptiveHuffman):
-    def __init__(self, stream):
-        super().__init__()
-        self.stream = stream
-        self.stream_idx = 0
-
-    def receive(self) -> int:
-        if self.stream_idx == len(self.stream):
-            raise CompletedException
-        ret = self.stream[self.stream_idx]
-        self.stream_idx += 1
-        # print(f"Consumed {ret}")
-        return ret
-
-    def decompress(self):
-        # print("_"*10)
-        res = ""
-        while True:
-            try:
-                # import pdb; pdb.set_trace()
-                # Bug: Had this as self.ALPHABET_SIZE-1 but should be self.ALPHABET_SIZE
-                if self.M == self.ALPHABET_SIZE:
-                    node = self.M-1
-                else:
-                    node = self.NUM_NODES_POSSIBLE-1
-                consumed = 0
-                # import pdb; pdb.set_trace()
-                while node > self.ALPHABET_SIZE-1:
-                    bit = self.receive()
-                    # print(f"Node: {node}")
-                    node = self.find_child(node, bit)
-                    # print(f"Node {node} after consuming bit {bit}")
-                    consumed += 1
-                # print(f"Node {node}, leader: {self.leader_node[self.block[node]]}")
-
-                if node == self.M-1:
-                    # print(f"GOT NYT and consumed {consumed} bits to get here")
-                    node = 0
-                    # print(self.E)
-                    for i in range(self.E):
-                        node = 2*node+self.receive()
-                        consumed += 1
-                    if node < self.R:
-                        node = 2*node+self.receive()
-                        consumed += 1
-                    else:
-                        node = node+self.R
-                    # No need to do +1 here because didn't do -1 in compressor
-                # print(node, self.alphabet[node])
-                # print(f"DECOMPRESSOR GOT letter: {chr(self.alphabet[node])}, consumed: {consumed}, @ node: {node}")
-                res += chr(self.alphabet[node])
-                # Bug, was passing in node
-                self.update(self.alphabet[node])
-            except CompletedException:
-                # print("Done processing input on decompressor side")
+    # Default number of bits resolved per table lookup when decoding (0 walks the tree one bit at a time)
+    TABLE_BITS = 8
+    # A slide that rewires more nodes than this clears all tables instead of the entries that went through them
+    MAX_INVALIDATE = 64
+
+    def __init__(self, stream=None, table_bits=TABLE_BITS, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE, compact=False,
+                 aging_interval=0, max_weight=AdaptiveHuffman.MAX_WEIGHT, max_depth=0):
+        super().__init__(alphabet_size=alphabet_size, compact=compact, aging_interval=aging_interval,
+                         max_weight=max_weight, max_depth=max_depth)
+        if not 0 <= table_bits <= 16:
+            raise ValueError(f"table_bits has to be between 0 and 16, got {table_bits}")
+        self.stream = stream if stream is not None else bitarray()
+        self.table_bits = table_bits
+        self._tables = {}
+        self._tables_version = -1
+
+    def _clear_caches(self):
+        # Only the model was replaced, the stream is left alone
+        self._tables.clear()
+        self._tables_version = -1
+
+    def decode_symbol(self, bits, idx, end) -> Tuple[Optional[int], int]:
+        # Decode one symbol from bits[idx:end]. Returns (alphabet index, index of the next unread bit), or (None, idx)
+        # if there aren't enough bits for a whole symbol yet. The tree is only updated once the whole symbol has been
+        # read, so the caller can just retry from the same idx once more bits are available.
+        bits = big_endian(bits)
+        if self.table_bits:
+            with memoryview(bits) as buf:
+                return self._decode_symbol(bits, buf, idx, end)
+        return self._decode_symbol(bits, None, idx, end)
+
+    def _decode_symbol(self, bits, buf, idx, end):
+        start = idx
+        # Bug: Had this as self.ALPHABET_SIZE-1 but should be self.ALPHABET_SIZE
+        if self.M == self.ALPHABET_SIZE:
+            node = self.M-1
+        else:
+            node = self.NUM_NODES_POSSIBLE-1
+        if buf is not None:
+            node, idx = self._walk_tables(buf, node, idx, end)
+        # Whatever is left (or everything without tables) one bit at a time
+        while node > self.ALPHABET_SIZE-1:
+            if idx == end:
+                return None, start
+            node = self.find_child(node, bits[idx])
+            idx += 1
+
+        if node == self.M-1:
+            # Got NYT, the index of the new letter follows in E or E+1 bits. Read E+1 in one go (if there are that
+            # many left) and give the last one back if the first E say it isn't part of the index.
+            E = self.E
+            if idx + E > end:
+                return None, start
+            count = E+1 if idx+E < end else E
+            value = read_bits(bits, buf, idx, count)
+            node = value >> (count-E)
+            if node < self.R:
+                if count == E:
+                    return None, start
+                node = value
+                idx += E+1
+            else:
+                node = node+self.R
+                idx += E
+            # No need to do +1 here because didn't do -1 in compressor
+        alphabet_idx = self.alphabet[node]
+        # Bug, was passing in node
+        self.update(alphabet_idx)
+        return alphabet_idx, idx
+
+    def _walk_tables(self, buf, node, idx, end):
+        # Go down the tree table_bits bits at a time while that many bits are left. There is a table per start node
+        # mapping the next k bits to where they lead and how many of them it took (fewer than k if we hit a leaf).
+        # Entries only depend on the shape of the tree, so they are filled in lazily and only dropped for the paths a
+        # slide actually rewires (see before_slide). Anything else that changes the shape clears all of them.
+        if self._tables_version != self.topology_version:
+            self._tables.clear()
+            self._tables_version = self.topology_version
+        tables = self._tables
+        k = self.table_bits
+        mask = (1 << k) - 1
+        last_byte = len(buf) - 3
+        while node > self.ALPHABET_SIZE-1 and idx + k <= end:
+            i = idx >> 3
+            if i > last_byte:
                 break
-        # print(res)
+            # Next k bits (k <= 16 so they always fit in 3 bytes)
+            pattern = ((buf[i] << 16 | buf[i+1] << 8 | buf[i+2]) >> (24 - k - (idx & 7))) & mask
+            table = tables.get(node)
+            if table is None:
+                table = tables[node] = [None] * (1 << k)
+            entry = table[pattern]
+            if entry is None:
+                entry = table[pattern] = self._table_entry(node, pattern)
+            node, used = entry
+            idx += used
+        return node, idx
+
+    def _table_entry(self, node, pattern):
+        k = self.table_bits
+        used = 0
+        while used < k and node > self.ALPHABET_SIZE-1:
+            used += 1
+            node = self.find_child(node, (pattern >> (k-used)) & 1)
+        return node, used
+
+    def before_slide(self, node_parent, next_block):
+        in_sync = self._tables_version == self.topology_version
+        super().before_slide(node_parent, next_block)
+        if not in_sync or not self._tables:
+            return
+        first = self.find_parent(self.last_node[next_block])
+        num_changed = self.parent[next_block] - first + 2
+        if num_changed > self.MAX_INVALIDATE or len(self._tables) < num_changed * self.table_bits:
+            # With large alphabets blocks can hold thousands of nodes, and while the tree is young there are only a few
+            # tables that are rebuilt quickly. Either way dropping everything is cheaper than finding the stale entries.
+            self._tables.clear()
+            self._tables_version = self.topology_version
+            return
+        changed = list(range(first, self.parent[next_block]+1))
+        if node_parent != NO_PARENT:
+            changed.append(node_parent)
+        # An entry is stale if its path goes through one of the changed nodes, i.e. for a changed node d levels below
+        # the table's node, the entries whose first d bits spell out the path down to it. Walk up k levels from each
+        # changed node collecting that path.
+        k = self.table_bits
+        root = self.NUM_NODES_POSSIBLE-1
+        tables = self._tables
+        for node in changed:
+            path = 0
+            for depth in range(k):
+                table = tables.get(node)
+                if table is not None:
+                    width = 1 << (k-depth)
+                    table[path*width:(path+1)*width] = [None] * width
+                if node == root:
+                    break
+                node_block = self.block[node]
+                path |= ((self.leader_node[node_block] - node + self.parity[node_block]) % 2) << depth
+                node = self.find_parent(node)
+        self._tables_version = self.topology_version
+
+    def new_output(self):
+        # Buffer decode() appends symbols to: a bytearray for byte alphabets, otherwise an array wide enough for them
+        if self.symbol_typecode == "B":
+            return bytearray()
+        return array(self.symbol_typecode)
+
+    @staticmethod
+    def output_bytes(out):
+        # Raw bytes of a buffer from new_output(), wide symbols little endian
+        if isinstance(out, bytearray):
+            return out
+        if sys.byteorder == "big":
+            out.byteswap()
+        return memoryview(out).cast("B")
+
+    def decode(self, bits, idx, end, out) -> int:
+        # Decode as many whole symbols as bits[idx:end] holds into out, returns the index of the first unused bit.
+        # Little endian bits are converted once up front.
+        bits = big_endian(bits)
+        buf = memoryview(bits) if self.table_bits else None
+        try:
+            decode_symbol = self._decode_symbol
+            while True:
+                alphabet_idx, idx = decode_symbol(bits, buf, idx, end)
+                if alphabet_idx is None:
+                    return idx
+                out.append(alphabet_idx)
+        finally:
+            if buf is not None:
+                buf.release()
+
+    def decompress(self) -> bytes:
+        out = self.new_output()
+        idx = self.decode(self.stream, 0, len(self.stream), out)
+        if idx != len(self.stream):
+            raise ValueError(f"Stream ends in the middle of a symbol ({len(self.stream)-idx} bits left over)")
+        return bytes(self.output_bytes(out))
+
+    def decompress_chunks(self, chunks: Iterable[bytes], num_bits: Optional[int] = None) -> Iterator:
+        """
+        Incrementally decode compressed bytes as they arrive, yielding a block of decoded bytes per chunk (a bytearray,
+        or for alphabets larger than 256 a memoryview of the symbols laid out little endian).
+
+        Only the bits that don't make up a whole symbol yet are kept between chunks, so memory is bounded by the chunk
+        size. num_bits is the number of meaningful bits in the stream (see AdaptiveHuffmanWriter.bits_written): any bits
+        after it are padding and are ignored. Without it, leftover bits at the end that don't complete a symbol are
+        treated as padding, but zero padding that happens to complete a symbol can't be told apart from data.
+        """
+        bits = bitarray()
+        offset = 0      # Position of bits[0] in the whole stream
+        for chunk in chunks:
+            bits.frombytes(chunk)
+            end = len(bits) if num_bits is None else min(len(bits), num_bits-offset)
+            out = self.new_output()
+            idx = self.decode(bits, 0, end, out)
+            # Drop what we consumed so we only hold on to a partial symbol
+            del bits[:idx]
+            offset += idx
+            if out:
+                yield self.output_bytes(out)
+        # End of stream
+        if num_bits is not None and offset != num_bits:
+            raise ValueError(f"Truncated stream: decoded {offset} of {num_bits} bits")
@@ -0,0 +1,134 @@
+"""
+Block-parallel compression on a process pool.
+
+The adaptive model is sequential, so a single stream can only use one core. Here the input is cut into blocks that are
+coded independently (each with a fresh model) in worker processes and written to the same container format as
+container.compress_file, so either side can be done serially or in parallel. Smaller blocks spread better over the
+workers but each one starts from an empty model and pays to learn the statistics again; block_size_report measures
+that trade-off.
+
+    python -m vitters_algorithm.parallel file [--workers N] [--block-sizes 1048576 4194304 ...]
+"""
+import argparse
+import io
+import os
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from .core import AdaptiveHuffman, symbol_typecode
+from .container import (BLOCK_CODERS, ContainerReader, ContainerWriter, DEFAULT_BLOCK_SIZE, compress_file,
+                        decompress_file, input_size, pick_codec)
+
+
+def _read_full(src, size):
+    # read() may return less than asked for before the end (pipes, sockets)
+    data = src.read(size)
+    while data and len(data) < size:
+        more = src.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def compress_file_parallel(src, dst, block_size=DEFAULT_BLOCK_SIZE, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE,
+                           max_workers=None, codec="adaptive"):
+    """
+    Same output as container.compress_file, with the blocks coded on a process pool.
+
+    At most 2 blocks per worker are in flight, so memory is bounded by the block size rather than the input size.
+    Returns the number of symbols written.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    itemsize = array(symbol_typecode(alphabet_size)).itemsize
+    if codec == "auto":
+        codec = pick_codec(input_size(src))
+    with ProcessPoolExecutor(max_workers) as executor, \
+            ContainerWriter(dst, block_size=block_size, alphabet_size=alphabet_size, codec=codec) as writer:
+        encode_block = BLOCK_CODERS[codec][0]
+        window = 2 * max_workers
+        pending = deque()
+        while True:
+            data = _read_full(src, block_size * itemsize)
+            if not data:
+                break
+            pending.append((len(data) // itemsize, executor.submit(encode_block, data, alphabet_size)))
+            if len(pending) >= window:
+                num_symbols, future = pending.popleft()
+                writer.write_encoded_block(num_symbols, *future.result())
+        while pending:
+            num_symbols, future = pending.popleft()
+            writer.write_encoded_block(num_symbols, *future.result())
+    return writer.num_symbols
+
+
+def decompress_file_parallel(src, dst, max_workers=None):
+    # Same as container.decompress_file with the blocks decoded on a process pool. Returns the number of symbols written.
+    max_workers = max_workers or os.cpu_count() or 1
+    reader = ContainerReader(src)
+    decode_block = BLOCK_CODERS[reader.codec][1]
+    with ProcessPoolExecutor(max_workers) as executor:
+        window = 2 * max_workers
+        pending = deque()
+        for info, payload in reader.payloads():
+            pending.append(executor.submit(decode_block, payload, info.num_bits, info.num_symbols,
+                                           reader.alphabet_size))
+            if len(pending) >= window:
+                dst.write(pending.popleft().result())
+        while pending:
+            dst.write(pending.popleft().result())
+    return reader.num_symbols
+
+
+def block_size_report(data, block_sizes, max_workers=None):
+    """
+    Compress data (bytes) once per block size, serially and on the pool, and check the round trip.
+
+    Returns a list of dicts with the block size, number of blocks, compression ratio (input / container size) and the
+    serial and parallel compression and decompression times.
+    """
+    rows = []
+    for block_size in block_sizes:
+        row = {"block_size": block_size}
+        out = io.BytesIO()
+        start = time.perf_counter()
+        compress_file(io.BytesIO(data), out, block_size=block_size)
+        row["compress_serial"] = time.perf_counter() - start
+        serial = out.getvalue()
+        out = io.BytesIO()
+        start = time.perf_counter()
+        compress_file_parallel(io.BytesIO(data), out, block_size=block_size, max_workers=max_workers)
+        row["compress_parallel"] = time.perf_counter() - start
+        if out.getvalue() != serial:
+            raise AssertionError(f"Parallel and serial containers differ for block size {block_size}")
+        row["num_blocks"] = -(-len(data) // block_size)
+        row["ratio"] = len(data) / len(serial)
+        for mode, decompress in (("serial", decompress_file), ("parallel", decompress_file_parallel)):
+            out = io.BytesIO()
+            start = time.perf_counter()
+            decompress(io.BytesIO(serial), out)
+            row["decompress_" + mode] = time.perf_counter() - start
+            if out.getvalue() != data:
+                raise AssertionError(f"{mode} round trip failed for block size {block_size}")
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", help="file to measure on")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24])
+    args = parser.parse_args()
+    with open(args.file, "rb") as f:
+        data = f.read()
+    print(f"{len(data)} bytes, {args.workers or os.cpu_count()} workers")
+    print(f"{'block size':>10} {'blocks':>6} {'ratio':>6} {'comp 1x':>8} {'comp Nx':>8} {'speedup':>7} "
+          f"{'dec 1x':>8} {'dec Nx':>8} {'speedup':>7}")
+    for row in block_size_report(data, args.block_sizes, args.workers):
+        print(f"{row['block_size']:>10} {row['num_blocks']:>6} {row['ratio']:>6.3f} "
+              f"{row['compress_serial']:>7.2f}s {row['compress_parallel']:>7.2f}s "
+              f"{row['compress_serial'] / row['compress_parallel']:>6.2f}x "
+              f"{row['decompress_serial']:>7.2f}s {row['decompress_parallel']:>7.2f}s "
+              f"{row['decompress_serial'] / row['decompress_parallel']:>6.2f}x")
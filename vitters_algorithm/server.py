@@ -0,0 +1,392 @@
+"""
+asyncio codec service: many independent adaptive encode/decode sessions multiplexed over local sockets.
+
+    python -m vitters_algorithm.server serve --unix /tmp/vh.sock        (or --port 7474)
+    python -m vitters_algorithm.server load-test --sessions 64 --messages 200 --size 1024
+
+Every session is a stream coded message by message with its own context: an encode session's messages come back
+compressed, a decode session takes those in the same order and gives the originals back. Each message is padded to a
+whole byte and the response says how many bits are meaningful, so messages can be sent and decoded one at a time.
+
+Frames (integers little endian):
+
+    request    op u8 | session id u64 | number of bits u64 (decode, otherwise 0) | payload length u32 | payload
+    response   status u8 | number of bits u64 (encode, otherwise 0) | payload length u32 | payload
+
+op is ENCODE, DECODE or CLOSE (forget the session, once its requests in progress are done). Encode and decode sessions
+with the same id are separate. A request with status ERROR gets the message as its payload. A failed encode leaves its
+session as it was (messages are checked before any symbol is coded); a decode session that failed is dropped since its
+model can't be trusted any more.
+
+At most capacity contexts are live; the least recently used one is evicted to a snapshot (see
+AdaptiveHuffman.snapshot) and restored when its session comes back. Messages of offload_size bytes or more are coded
+on a process pool, the model going there and back as a snapshot, so big blocks don't hold up the other sessions.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from bitarray import bitarray
+from .core import AdaptiveHuffman, symbols_from_bytes
+from .compressor import AdaptiveHuffmanCompressor
+from .decompressor import AdaptiveHuffmanDecompress
+
+REQUEST = struct.Struct("<BQQI")
+RESPONSE = struct.Struct("<BQI")
+ENCODE, DECODE, CLOSE = 1, 2, 3
+OK, ERROR = 0, 1
+MAX_PAYLOAD = 64 << 20
+DEFAULT_CAPACITY = 1024
+DEFAULT_OFFLOAD_SIZE = 64 << 10
+DEFAULT_PORT = 7474
+
+
+def encode_message(compressor, data):
+    # Returns (payload, number of bits); the payload ends on a byte boundary so the next message starts on a new one
+    alphabet_size = compressor.ALPHABET_SIZE
+    symbols = symbols_from_bytes(data, compressor.symbol_typecode)
+    # Checked up front, the model mustn't take in part of a message that fails
+    if len(symbols) and alphabet_size < 1 << (8*symbols.itemsize) and max(symbols) >= alphabet_size:
+        raise ValueError(f"Symbol {max(symbols)} is outside the alphabet of {alphabet_size} symbols")
+    out = bytearray()
+    num_bits = compressor.encode_bytes(symbols, out)
+    return bytes(out), num_bits
+
+
+def decode_message(decompressor, payload, num_bits):
+    bits = bitarray()
+    bits.frombytes(payload)
+    if num_bits > len(bits):
+        raise ValueError(f"Message has {len(bits)} bits, header says {num_bits}")
+    out = decompressor.new_output()
+    if decompressor.decode(bits, 0, num_bits, out) != num_bits:
+        raise ValueError("Message ends in the middle of a symbol")
+    return bytes(decompressor.output_bytes(out))
+
+
+def _code_in_worker(op, snapshot, payload, num_bits):
+    # Runs in the process pool: code one message from the session's snapshot, returns the new snapshot with the result
+    if op == ENCODE:
+        model = AdaptiveHuffmanCompressor.from_snapshot(snapshot)
+        payload, num_bits = encode_message(model, payload)
+    else:
+        model = AdaptiveHuffmanDecompress.from_snapshot(snapshot)
+        payload, num_bits = decode_message(model, payload, num_bits), 0
+    return model.snapshot(), payload, num_bits
+
+
+class ContextPool:
+    """
+    Codec contexts by (op, session id), at most capacity of them live. The least recently used one is evicted to a
+    snapshot, and its object is reused for the context that took its place.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+        if capacity < 1:
+            raise ValueError(f"capacity has to be at least 1, got {capacity}")
+        self.capacity = capacity
+        self.alphabet_size = alphabet_size
+        self._live = OrderedDict()
+        self._snapshots = {}
+        self.evictions = 0
+        self.restores = 0
+
+    def __len__(self):
+        return len(self._live) + len(self._snapshots)
+
+    def get(self, key):
+        # The live context for key, restoring or creating it (and evicting another) if needed
+        model = self._live.get(key)
+        if model is not None:
+            self._live.move_to_end(key)
+            return model
+        cls = AdaptiveHuffmanCompressor if key[0] == ENCODE else AdaptiveHuffmanDecompress
+        if len(self._live) >= self.capacity:
+            victim_key, victim = self._live.popitem(last=False)
+            self._snapshots[victim_key] = victim.snapshot()
+            self.evictions += 1
+            model = victim if type(victim) is cls else None
+        snapshot = self._snapshots.pop(key, None)
+        if model is None:
+            model = cls(alphabet_size=self.alphabet_size)
+            if snapshot is not None:
+                model.restore(snapshot)
+        elif snapshot is not None:
+            model.restore(snapshot)
+        else:
+            model.reset()
+        if snapshot is not None:
+            self.restores += 1
+        self._live[key] = model
+        return model
+
+    def snapshot(self, key):
+        # Current state of key's context (live or evicted) as a snapshot, None for a session that doesn't exist yet
+        model = self._live.get(key)
+        if model is not None:
+            return model.snapshot()
+        return self._snapshots.get(key)
+
+    def store(self, key, snapshot):
+        # Replace key's state with a snapshot (e.g. one coded in another process), wherever the context is now
+        model = self._live.get(key)
+        if model is not None:
+            model.restore(snapshot)
+        else:
+            self._snapshots[key] = snapshot
+
+    def drop(self, key):
+        self._live.pop(key, None)
+        self._snapshots.pop(key, None)
+
+
+class CodecServer:
+    def __init__(self, capacity=DEFAULT_CAPACITY, offload_size=DEFAULT_OFFLOAD_SIZE, max_workers=None,
+                 alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+        self.pool = ContextPool(capacity, alphabet_size)
+        self.offload_size = offload_size
+        self.max_workers = max_workers
+        self._executor = None
+        self._locks = {}        # Session key -> [lock held while it is coded or closed, requests holding/awaiting it]
+        self._connections = set()       # Tasks of the connections being served
+        self.requests = 0
+        self.offloaded = 0
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+        # Listen on a unix socket if path is given, otherwise on TCP. Returns the asyncio server.
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def wait_connections(self):
+        # Wait for the connections being served to end (after their clients hung up, or the listener was closed)
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    op, session, num_bits, length = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                except asyncio.IncompleteReadError:
+                    break
+                if length > MAX_PAYLOAD:
+                    writer.write(self._error(f"Payload of {length} bytes is over the limit"))
+                    break
+                payload = await reader.readexactly(length)
+                writer.write(await self.request(op, session, num_bits, payload))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # Client went away
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _error(message):
+        message = message.encode()
+        return RESPONSE.pack(ERROR, 0, len(message)) + message
+
+    async def request(self, op, session, num_bits, payload) -> bytes:
+        # One request, returns the response frame
+        self.requests += 1
+        if op == CLOSE:
+            # After any request of the session still being coded, which would otherwise store its state back
+            for key in ((ENCODE, session), (DECODE, session)):
+                async with self._session(key):
+                    self.pool.drop(key)
+            return RESPONSE.pack(OK, 0, 0)
+        if op not in (ENCODE, DECODE):
+            return self._error(f"Unknown op {op}")
+        key = (op, session)
+        async with self._session(key):
+            try:
+                if len(payload) >= self.offload_size:
+                    payload, num_bits = await self._offload(key, payload, num_bits)
+                elif op == ENCODE:
+                    payload, num_bits = encode_message(self.pool.get(key), payload)
+                else:
+                    payload, num_bits = decode_message(self.pool.get(key), payload, num_bits), 0
+            except (ValueError, IndexError) as e:
+                if op == DECODE:
+                    self.pool.drop(key)
+                return self._error(f"{type(e).__name__}: {e}")
+        return RESPONSE.pack(OK, num_bits, len(payload)) + payload
+
+    @asynccontextmanager
+    async def _session(self, key):
+        # Hold key's lock. The lock is dropped once no request holds or waits for it, so sessions whose clients went
+        # away without CLOSE don't leave one behind.
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _offload(self, key, payload, num_bits):
+        if self._executor is None:
+            # Not forked: a forked worker would hold on to the sockets of the connections open at the time, so they
+            # wouldn't close when the client (or this server) closes them
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=context)
+        snapshot = self.pool.snapshot(key)
+        if snapshot is None:
+            snapshot = self.pool.get(key).snapshot()
+        loop = asyncio.get_running_loop()
+        snapshot, payload, num_bits = await loop.run_in_executor(self._executor, _code_in_worker, key[0], snapshot,
+                                                                 payload, num_bits)
+        self.pool.store(key, snapshot)
+        self.offloaded += 1
+        return payload, num_bits
+
+
+class CodecClient:
+    # One connection; requests on it are sent one at a time, any number of sessions can share it
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+        if path is not None:
+            return cls(*await asyncio.open_unix_connection(path))
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def _request(self, op, session, num_bits=0, payload=b""):
+        self.writer.write(REQUEST.pack(op, session, num_bits, len(payload)) + payload)
+        await self.writer.drain()
+        status, num_bits, length = RESPONSE.unpack(await self.reader.readexactly(RESPONSE.size))
+        payload = await self.reader.readexactly(length)
+        if status != OK:
+            raise ValueError(payload.decode())
+        return payload, num_bits
+
+    async def encode(self, session, data):
+        # Returns (payload, number of bits)
+        return await self._request(ENCODE, session, 0, data)
+
+    async def decode(self, session, payload, num_bits):
+        return (await self._request(DECODE, session, num_bits, payload))[0]
+
+    async def close_session(self, session):
+        await self._request(CLOSE, session)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples)-1, int(q * len(samples)))]
+
+
+async def load_test(sessions=64, messages=100, size=1024, host="127.0.0.1", port=DEFAULT_PORT, path=None, seed=274):
+    """
+    Run sessions concurrent clients, each on its own connection, encoding messages messages of size bytes in a session
+    of its own and decoding them in another, checking the round trip. Returns request latency percentiles (seconds,
+    encode and decode requests alike), aggregate throughput (message bytes encoded and decoded per second) and counts.
+    """
+    import random
+    rng = random.Random(seed)
+    words = [bytes(rng.choices(b"etaoinshrdlucmfwyp", k=rng.randint(2, 9))) for _ in range(200)]
+    latencies = []
+
+    async def client(session):
+        local = random.Random(f"{seed}-{session}")
+        connection = await CodecClient.connect(host, port, path)
+        clock = time.perf_counter
+        try:
+            for _ in range(messages):
+                data = b" ".join(local.choices(words, k=size // 5))[:size]
+                start = clock()
+                payload, num_bits = await connection.encode(session, data)
+                middle = clock()
+                decoded = await connection.decode(session, payload, num_bits)
+                latencies.append(middle - start)
+                latencies.append(clock() - middle)
+                if decoded != data:
+                    raise AssertionError(f"Session {session} round trip failed")
+            await connection.close_session(session)
+        finally:
+            await connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(session) for session in range(sessions)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "sessions": sessions, "messages": messages, "size": size, "requests": len(latencies), "seconds": elapsed,
+        "throughput_mb_s": 2 * sessions * messages * size / elapsed / 1e6,
+        "p50_ms": _percentile(latencies, 0.5) * 1e3, "p99_ms": _percentile(latencies, 0.99) * 1e3,
+        "max_ms": latencies[-1] * 1e3,
+    }
+
+
+async def _serve(args):
+    server = CodecServer(args.capacity, args.offload_size, args.workers)
+    listener = await server.start(args.host, args.port, args.unix)
+    print(f"Listening on {args.unix or f'{args.host}:{args.port}'}", file=sys.stderr)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+async def _load_test(args):
+    server = None
+    if not args.connect:
+        # Server in this process, so the numbers include its event loop but not the network
+        server = CodecServer(args.capacity, args.offload_size, args.workers)
+        listener = await server.start(args.host, args.port, args.unix)
+    try:
+        result = await load_test(args.sessions, args.messages, args.size, args.host, args.port, args.unix)
+    finally:
+        if server is not None:
+            listener.close()
+            await listener.wait_closed()
+            await server.wait_connections()
+            server.close()
+    if server is not None:
+        result.update(evictions=server.pool.evictions, restores=server.pool.restores, offloaded=server.offloaded)
+    for name, value in result.items():
+        print(f"{name:>16} {value:.3f}" if isinstance(value, float) else f"{name:>16} {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adaptive Huffman codec server")
+    parser.add_argument("command", choices=("serve", "load-test"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", help="unix socket path instead of TCP")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY, help="live codec contexts")
+    parser.add_argument("--offload-size", type=int, default=DEFAULT_OFFLOAD_SIZE,
+                        help="messages this large are coded on the process pool")
+    parser.add_argument("--workers", type=int, default=None, help="process pool size (default: one per core)")
+    parser.add_argument("--sessions", type=int, default=64, help="load-test: concurrent clients")
+    parser.add_argument("--messages", type=int, default=100, help="load-test: messages per client")
+    parser.add_argument("--size", type=int, default=1024, help="load-test: bytes per message")
+    parser.add_argument("--connect", action="store_true", help="load-test: use a running server instead of starting one")
+    args = parser.parse_args()
+    if args.unix is not None and args.command == "serve" and os.path.exists(args.unix):
+        os.unlink(args.unix)
+    asyncio.run(_serve(args) if args.command == "serve" else _load_test(args))
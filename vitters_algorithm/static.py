@@ -0,0 +1,100 @@
+"""
+Semi-static (two pass) Huffman coding of whole blocks.
+
+The symbols of a block are counted first, a canonical Huffman code is built from the counts and the block is coded
+with bitarray's C encoder and canonical decoder. There is no model to update per symbol, so this is much faster than
+the adaptive coder, at the cost of a code table per block and having the whole block before anything is coded. The
+container uses it for files written with codec="static".
+
+Payload layout (integers little endian):
+
+    max code length u8 | number of codes of each length 1..max, u32 each | symbols in canonical order, 1/2/4 bytes each
+    code bits, zero padded to a byte
+
+An empty block has an empty payload.
+"""
+import struct
+import sys
+from array import array
+from collections import Counter
+from bitarray import bitarray
+from bitarray.util import canonical_decode, canonical_huffman
+from .core import AdaptiveHuffman, symbol_typecode, symbols_from_bytes
+
+try:
+    import numpy as np
+except ImportError:     # Counting falls back to bytes.count / Counter
+    np = None
+
+LENGTH_COUNT = struct.Struct("<I")
+
+
+def symbol_counts(data, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    # {symbol: count} in symbol order for the symbols in data (bytes, or 2/4 byte little endian symbols for larger
+    # alphabets)
+    typecode = symbol_typecode(alphabet_size)
+    if np is not None:
+        dtype = {"B": "u1", "H": "<u2", "I": "<u4"}[typecode]
+        counts = np.bincount(np.frombuffer(data, dtype=dtype), minlength=alphabet_size)
+        if len(counts) > alphabet_size:
+            raise ValueError(f"Symbol {len(counts)-1} is outside the alphabet of {alphabet_size}")
+        symbols = np.flatnonzero(counts)
+        return dict(zip(symbols.tolist(), counts[symbols].tolist()))
+    if typecode == "B":
+        data = bytes(data) if isinstance(data, memoryview) else data
+        counts = {symbol: count for symbol in range(256) if (count := data.count(symbol))}
+    else:
+        # In symbol order like the other two, canonical_huffman breaks ties by it
+        counts = dict(sorted(Counter(symbols_from_bytes(data, typecode)).items()))
+    if counts and max(counts) >= alphabet_size:
+        raise ValueError(f"Symbol {max(counts)} is outside the alphabet of {alphabet_size}")
+    return counts
+
+
+def encode_block(data, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    # Code data with a canonical code for its own counts, returns (payload, number of meaningful bits)
+    typecode = symbol_typecode(alphabet_size)
+    counts = symbol_counts(data, alphabet_size)
+    if not counts:
+        return b"", 0
+    code, length_counts, symbols = canonical_huffman(counts)
+    table = bytearray([len(length_counts)-1])
+    for count in length_counts[1:]:
+        table += LENGTH_COUNT.pack(count)
+    symbols = array(typecode, symbols)
+    if sys.byteorder == "big":
+        symbols.byteswap()
+    table += symbols.tobytes()
+    bits = bitarray(endian="big")
+    bits.encode(code, symbols_from_bytes(data, typecode))
+    return bytes(table) + bits.tobytes(), 8*len(table) + len(bits)
+
+
+def decode_block(payload, num_bits, num_symbols, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    # Inverse of encode_block, returns the symbols as a bytearray (little endian for wide symbols)
+    if not num_symbols:
+        return bytearray()
+    typecode = symbol_typecode(alphabet_size)
+    payload = memoryview(payload)
+    max_length = payload[0]
+    length_counts = [0] + [LENGTH_COUNT.unpack_from(payload, 1 + 4*i)[0] for i in range(max_length)]
+    offset = 1 + 4*max_length
+    itemsize = array(typecode).itemsize
+    symbols = symbols_from_bytes(payload[offset:offset + sum(length_counts)*itemsize], typecode)
+    offset += len(symbols)*symbols.itemsize
+    if len(symbols) != sum(length_counts) or any(symbol >= alphabet_size for symbol in symbols):
+        raise ValueError("Corrupt code table")
+    bits = bitarray(endian="big")
+    bits.frombytes(payload[offset:])
+    del bits[num_bits - 8*offset:]
+    decoded = canonical_decode(bits, length_counts, symbols.tolist())
+    if typecode == "B":
+        out = bytearray(decoded)
+    else:
+        out = array(typecode, decoded)
+        if sys.byteorder == "big":
+            out.byteswap()
+        out = bytearray(out.tobytes())
+    if len(out) // array(typecode).itemsize != num_symbols:
+        raise ValueError(f"Block decoded to {len(out) // array(typecode).itemsize} symbols, expected {num_symbols}")
+    return out
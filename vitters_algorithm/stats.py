@@ -0,0 +1,147 @@
+"""
+Counters for what AdaptiveHuffman.update does, see AdaptiveHuffman.enable_stats().
+
+The counting is done by wrappers set as attributes of the one instance being watched, so the class methods (and any
+model that didn't enable stats) run exactly as before. Block allocations, frees and merges are inferred from
+available_block and the node's block around each slide_and_increment call rather than counted inside it.
+"""
+from collections import Counter
+
+# Methods replaced on the instance while stats are enabled
+WRAPPED = ("update", "spawn_new_node", "slide_and_increment", "before_slide", "find_child")
+
+
+class UpdateStats:
+    def __init__(self, model):
+        self.model = model
+        self.symbols = 0
+        self.spawns = 0                 # New symbols (spawn_new_node calls)
+        self.increments = 0             # slide_and_increment calls
+        self.increments_per_symbol = Counter()
+        self.slides = 0                 # Increments where a node slid over the next block
+        self.blocks_allocated = 0       # Taken from the free list: a node splitting off into a block of its own
+        self.blocks_freed = 0           # Returned to the free list: the last node of a block merging into the next
+        self.merges = 0                 # A node joining the next block (whether or not that emptied its own)
+        self.find_child_calls = 0
+        self.longest_codeword = 0       # Including the index bits of escapes
+        # Most increments done for one symbol beyond the length of its codeword. Vitter's bound says this stays a small
+        # constant (the leaf and its sibling of the 0-node, plus the root).
+        self.max_increments_over_length = 0
+        self.replaced = {}              # Method name -> (what the instance had before, the counting wrapper)
+
+    def tree_depth(self):
+        # Depth of the deepest leaf right now. Parents always have a higher implicit number than their children, so one
+        # pass from the root down does it.
+        model = self.model
+        if model.M == model.ALPHABET_SIZE:
+            return 0
+        root = model.NUM_NODES_POSSIBLE-1
+        depth = {root: 0}
+        deepest = 0
+        # Live nodes: the internal nodes from the root down and the leaves from the last one down to the 0-node
+        for node in range(root-1, max(model.M-1, 0)-1, -1):
+            if node < model.ALPHABET_SIZE or node >= model.ALPHABET_SIZE + model.M - 1:
+                depth[node] = depth[model.find_parent(node)] + 1
+                deepest = max(deepest, depth[node])
+        return deepest
+
+    def as_dict(self):
+        return {
+            "symbols": self.symbols,
+            "spawns": self.spawns,
+            "increments": self.increments,
+            "increments_per_symbol": dict(sorted(self.increments_per_symbol.items())),
+            "max_increments_per_symbol": max(self.increments_per_symbol, default=0),
+            "slides": self.slides,
+            "blocks_allocated": self.blocks_allocated,
+            "blocks_freed": self.blocks_freed,
+            "merges": self.merges,
+            "find_child_calls": self.find_child_calls,
+            "longest_codeword": self.longest_codeword,
+            "max_increments_over_length": self.max_increments_over_length,
+            "tree_depth": self.tree_depth(),
+        }
+
+
+def codeword_length(model, alphabet_idx):
+    # Length of the code alphabet_idx gets right now: the path to its leaf, or to the 0-node plus E or E+1 index bits
+    node = model.representation[alphabet_idx]
+    length = 0
+    if node <= model.M-1:
+        length = model.E+1 if node < 2*model.R else model.E
+        node = model.M-1
+    root = model.ALPHABET_SIZE-1 if model.M == model.ALPHABET_SIZE else model.NUM_NODES_POSSIBLE-1
+    while node != root:
+        node = model.find_parent(node)
+        length += 1
+    return length
+
+
+def instrument(model) -> UpdateStats:
+    stats = UpdateStats(model)
+    # Whatever the instance had for each method (e.g. check.enable_checks' update), None for the class method
+    previous = {name: model.__dict__.get(name) for name in WRAPPED}
+    update = model.update
+    spawn_new_node = model.spawn_new_node
+    slide_and_increment = model.slide_and_increment
+    before_slide = model.before_slide
+    find_child = model.find_child
+
+    def counted_update(alphabet_idx):
+        length = codeword_length(model, alphabet_idx)
+        start = stats.increments
+        update(alphabet_idx)
+        increments = stats.increments - start
+        stats.symbols += 1
+        stats.increments_per_symbol[increments] += 1
+        stats.longest_codeword = max(stats.longest_codeword, length)
+        stats.max_increments_over_length = max(stats.max_increments_over_length, increments - length)
+
+    def counted_spawn_new_node(node):
+        available = model.available_block
+        result = spawn_new_node(node)
+        stats.spawns += 1
+        if model.available_block != available:
+            stats.blocks_allocated += 1
+        return result
+
+    def counted_slide_and_increment(node):
+        available = model.available_block
+        node_block = model.block[node]
+        result = slide_and_increment(node)
+        stats.increments += 1
+        if model.available_block == node_block:
+            stats.blocks_freed += 1
+            stats.merges += 1
+        elif model.available_block != available:
+            stats.blocks_allocated += 1
+        elif model.block[node] != node_block:
+            stats.merges += 1
+        return result
+
+    def counted_before_slide(node_parent, next_block):
+        stats.slides += 1
+        before_slide(node_parent, next_block)
+
+    def counted_find_child(node, direction):
+        stats.find_child_calls += 1
+        return find_child(node, direction)
+
+    model.update = counted_update
+    model.spawn_new_node = counted_spawn_new_node
+    model.slide_and_increment = counted_slide_and_increment
+    model.before_slide = counted_before_slide
+    model.find_child = counted_find_child
+    stats.replaced = {name: (previous[name], model.__dict__[name]) for name in WRAPPED}
+    return stats
+
+
+def uninstrument(model, stats):
+    # Undo instrument(). A wrapper someone set on top of ours afterwards is left in place (it keeps counting into stats).
+    for name, (previous, wrapper) in stats.replaced.items():
+        if model.__dict__.get(name) is not wrapper:
+            continue
+        if previous is None:
+            del model.__dict__[name]
+        else:
+            model.__dict__[name] = previous
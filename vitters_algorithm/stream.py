@@ -0,0 +1,108 @@
+import io
+from array import array
+from .core import AdaptiveHuffman, symbols_from_bytes
+from .compressor import AdaptiveHuffmanCompressor
+from .decompressor import AdaptiveHuffmanDecompress
+
+# How much input we encode before handing whole bytes to the destination. Memory use is bounded by this (plus the
+# compressed bits of one chunk), not by the size of the input.
+CHUNK_SIZE = 1 << 16
+
+
+class AdaptiveHuffmanWriter(io.RawIOBase):
+    """
+    File-like object that compresses everything written to it into the binary file object dst.
+
+    Only whole bytes are written to dst; the last partial byte is zero padded when the writer is closed. The exact
+    number of meaningful bits is available as bits_written (the padding is otherwise ambiguous). Closing the writer
+    does not close dst.
+
+    For alphabets larger than 256 every symbol takes 2 (or 4) bytes of input, little endian. alphabet_size is only used
+    when no compressor is given.
+    """
+    def __init__(self, dst, compressor=None, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+        super().__init__()
+        self.dst = dst
+        if compressor is None:
+            compressor = AdaptiveHuffmanCompressor(alphabet_size=alphabet_size)
+        self.compressor = compressor
+        self.bits_written = 0
+        self._typecode = compressor.symbol_typecode
+        self._itemsize = array(self._typecode).itemsize
+        # Bytes of a wide symbol whose remaining bytes haven't been written yet
+        self._partial = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed AdaptiveHuffmanWriter")
+        data = memoryview(data).cast("B")
+        size = len(data)
+        if self._itemsize > 1:
+            data = self._partial + data
+            whole = len(data) - len(data) % self._itemsize
+            self._partial = data[whole:]
+            data = symbols_from_bytes(data[:whole], self._typecode)
+        for start in range(0, len(data), CHUNK_SIZE):
+            self._encode_chunk(data[start:start+CHUNK_SIZE])
+        return size
+
+    def _encode_chunk(self, chunk):
+        alphabet_size = self.compressor.ALPHABET_SIZE
+        if alphabet_size < 1 << (8*self._itemsize) and max(chunk) >= alphabet_size:
+            raise ValueError(f"Symbol {max(chunk)} is outside the alphabet of {alphabet_size} symbols")
+        out = bytearray()
+        self.bits_written += self.compressor.encode_bytes(chunk, out, final=False)
+        if out:
+            self.dst.write(out)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._partial:
+                raise ValueError(f"Input ends in the middle of a {self._itemsize} byte symbol")
+            # Zero pad the final byte
+            out = bytearray()
+            self.compressor.encode_bytes(b"", out)
+            if out:
+                self.dst.write(out)
+            if hasattr(self.dst, "flush"):
+                self.dst.flush()
+        finally:
+            super().close()
+
+
+def compress_stream(src, dst, chunk_size=CHUNK_SIZE, compressor=None, alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    """
+    Compress the binary file object src into dst, reading chunk_size bytes at a time.
+
+    Returns the number of meaningful bits written (the final byte is zero padded).
+    """
+    with AdaptiveHuffmanWriter(dst, compressor=compressor, alphabet_size=alphabet_size) as writer:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+    return writer.bits_written
+
+
+def decompress_stream(src, dst, num_bits=None, chunk_size=CHUNK_SIZE, decompressor=None,
+                      alphabet_size=AdaptiveHuffman.ALPHABET_SIZE):
+    """
+    Decompress the binary file object src into dst, reading chunk_size bytes at a time.
+
+    num_bits is the number of meaningful bits returned by compress_stream (the rest of the final byte is padding).
+    Returns the number of decoded bytes written.
+    """
+    if decompressor is None:
+        decompressor = AdaptiveHuffmanDecompress(alphabet_size=alphabet_size)
+    written = 0
+    chunks = iter(lambda: src.read(chunk_size), b"")
+    for block in decompressor.decompress_chunks(chunks, num_bits=num_bits):
+        dst.write(block)
+        written += len(block)
+    return written